@@ -2,7 +2,7 @@
 
 {
     'name': 'Payment Provider: Novalnet',
-    'version': '4.0.0',
+    'version': '4.0.3',
     'category': 'Accounting/Payment Providers',
     'sequence': 350,
     'summary': "A global payment service provider.",
@@ -16,6 +16,7 @@
         'security/ir.model.access.csv',
         'data/payment_method_data.xml',
         'data/payment_provider_data.xml',
+        'data/ir_cron_data.xml',
     ],
     'images': ['static/description/cover.png'],
     'post_init_hook': 'post_init_hook',
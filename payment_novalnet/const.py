@@ -15,3 +15,14 @@ RESULT_CODES_MAPPING = {
     'DEACTIVATED': 'cancel',
     'FAILURE': 'error',
 }
+
+# Methods of `payment.transaction` moving a transaction to the mapped state
+STATE_SETTERS = {
+    'pending': '_set_pending',
+    'authorize': '_set_authorized',
+    'done': '_set_done',
+    'cancel': '_set_canceled',
+}
+
+# Novalnet status to its transaction state and the method setting it, None when the state is not handled
+STATUS_ACTIONS = {status: (state, STATE_SETTERS.get(state)) for status, state in RESULT_CODES_MAPPING.items()}
@@ -3,16 +3,21 @@
 """
  This is main.py controller file
 """
-import json
 import logging
-import pprint
 
 from odoo import _, http
 from odoo.exceptions import ValidationError
 from odoo.http import request
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 _logger = logging.getLogger(__name__)
 
+_REQUIRED_WEBHOOK_KEYS = frozenset({'event', 'result', 'transaction'})
+
 
 class PaymentNovalnetController(http.Controller):
     """
@@ -39,63 +44,82 @@ class PaymentNovalnetController(http.Controller):
         """
         request.env['payment.transaction'].sudo()._handle_notification_data('novalnet', data)
 
-    @http.route(webhook_url, type='json', auth='public', methods=['POST'], csrf=False, website=True)
-    def novalnet_webhook(self, **data):
+    @http.route(webhook_url, type='http', auth='public', methods=['POST'], csrf=False)
+    def novalnet_webhook(self):
         """
         Handles webhook notifications from Novalnet.
+
+        Novalnet posts a bare JSON object rather than a JSON-RPC envelope, so the body is parsed
+        once here instead of going through the JSON dispatcher first.
+
+        :return: An empty response to acknowledge the notification.
         """
-        data = json.loads(request.httprequest.data)
-        _logger.info("notification received from Novalnet with data:\n%s", pprint.pformat(data))
+        data = json_loads(request.httprequest.data)
+        _logger.info("notification received from Novalnet with data: %s", data)
 
-        if not {'event', 'result', 'transaction'} <= set(data):
+        if not _REQUIRED_WEBHOOK_KEYS.issubset(data):
             raise ValidationError(_("webhook necessary information not found"))
-        tid = data.get('event')['parent_tid'] if 'parent_tid' in data.get('event') else data.get('event')['tid']
-        event_type, checksum = data.get('event')['type'], data.get('event')['checksum']
-        if 'order_no' not in data.get('transaction'):
+        event, result, transaction = data['event'], data['result'], data['transaction']
+        tid = event.get('parent_tid') or event['tid']
+        event_type, checksum = event['type'], event['checksum']
+        if 'order_no' not in transaction:
             raise ValidationError(_("Order number not found"))
 
+        # `reference` is covered by the core `reference_uniq` index and `search` only fetches the id. The
+        # transaction is handed over as a record, so `_get_tx_from_notification_data` does not search it again
+        # and no `reference` needs to be passed along.
         transaction_info = request.env['payment.transaction'].sudo().search(
-            [('reference', '=', data.get('transaction')['order_no'])], limit=1)
+            [('reference', '=', transaction['order_no'])], limit=1)
         if not transaction_info:
             raise ValidationError(_("Could not found order number"))
         transaction_info._handle_notification_data('novalnet',
                                                    {'nn_tid': tid, 'event_type': event_type, 'check_sum': checksum,
-                                                    'nn_status': data.get('result')['status'],
-                                                    'nn_status_text': data.get('result')['status_text'],
-                                                    'reference': transaction_info.reference})
+                                                    'nn_status': result['status'],
+                                                    'nn_status_text': result['status_text'],
+                                                    'nn_callback_data': data})
+        return request.make_response('', status=200)
 
     @http.route(_return_url, type='http', auth='public')
     def novalnet_return_payment(self, **data):
         """
         Handles the return URL after processing a payment with Novalnet
         """
-        _logger.info(pprint.pformat(data))
+        _logger.info("return received from Novalnet with data: %s", data)
 
-        if not {'status', 'status_text', 'status_code'} <= set(data):
-            return request.render('payment_novalnet.novalnet_redirect_failure', {
-                'failure_message': _('Unknown error occured please try after some time')
-            })
+        if not ('status' in data and 'status_text' in data and 'status_code' in data):
+            return self._novalnet_failure_response(_('Unknown error occured please try after some time'))
 
         _nn_status, _nn_status_text = data['status'], data['status_text']
 
-        if not {'txn_secret', 'tid', 'checksum'} <= set(data):
-            return request.render('payment_novalnet.novalnet_redirect_failure', {
-                'failure_message': _nn_status_text
-            })
-        novalnet_transaction_info = request.env['payment.novalnet.transaction'].sudo().search(
-            [('novalnet_txn_secret', '=', data['txn_secret'])], limit=1)
-
-        if not novalnet_transaction_info:
-            return request.render('payment_novalnet.novalnet_redirect_failure', {
-                'failure_message': _('Could not found Novalnet transaction')
-            })
-        transaction_info = request.env['payment.transaction'].sudo().search(
-            [('novalnet_transaction_id', '=', novalnet_transaction_info.id)], limit=1)
+        if not ('txn_secret' in data and 'tid' in data and 'checksum' in data):
+            return self._novalnet_failure_response(_nn_status_text)
+        # Resolve the transaction through its Novalnet details with a single indexed join
+        request.env.cr.execute("""
+            SELECT tx.id
+              FROM payment_transaction tx
+              JOIN payment_novalnet_transaction nn_tx ON tx.novalnet_transaction_id = nn_tx.id
+             WHERE nn_tx.novalnet_txn_secret = %s
+             LIMIT 1
+        """, (data['txn_secret'],))
+        row = request.env.cr.fetchone()
+        transaction_info = request.env['payment.transaction'].sudo().browse(row and row[0])
         if not transaction_info:
-            return request.render('payment_novalnet.novalnet_redirect_failure', {
-                'failure_message': _('Could not found transaction')
-            })
+            # Only look up the Novalnet details on failure to report the right error
+            if not request.env['payment.novalnet.transaction'].sudo().search_count(
+                    [('novalnet_txn_secret', '=', data['txn_secret'])], limit=1):
+                return self._novalnet_failure_response(_('Could not found Novalnet transaction'))
+            return self._novalnet_failure_response(_('Could not found transaction'))
         transaction_info._handle_notification_data('novalnet', {'nn_tid': data['tid'], 'nn_status': _nn_status,
-                                                                'nn_status_text': _nn_status_text,
-                                                                'reference': transaction_info.reference})
+                                                                'nn_status_text': _nn_status_text})
         return request.redirect('/payment/status')
+
+    @staticmethod
+    def _novalnet_failure_response(failure_message):
+        """ Render the page alerting the customer that the redirect payment failed.
+
+        The compiled template is cached by QWeb, so only the message is evaluated per request.
+
+        :param str failure_message: The message to display to the customer.
+        :return: The lazy response rendering the failure template.
+        """
+        return request.render('payment_novalnet.novalnet_redirect_failure', {'failure_message': failure_message})
@@ -15,6 +15,21 @@ import logging
 
 _logger = logging.getLogger(__name__)
 
+# Keys expected to be passed to a transaction route
+_TRANSACTION_KWARGS_WHITELIST = frozenset({
+    'provider_id',
+    'payment_method_id',
+    'token_id',
+    'amount',
+    'flow',
+    'tokenization_requested',
+    'landing_route',
+    'is_validation',
+    'csrf_token',
+    'pay_data',
+    'pm_data',
+})
+
 
 class NovalnetPaymentPortal(portal.PaymentPortal):
 
@@ -33,21 +48,7 @@ class NovalnetPaymentPortal(portal.PaymentPortal):
         :return: None
         :raise ValidationError: If some kwargs keys are rejected.
         """
-        whitelist = {
-            'provider_id',
-            'payment_method_id',
-            'token_id',
-            'amount',
-            'flow',
-            'tokenization_requested',
-            'landing_route',
-            'is_validation',
-            'csrf_token',
-            'pay_data',
-            'pm_data'
-        }
-        whitelist.update(additional_allowed_keys)
-        rejected_keys = set(kwargs.keys()) - whitelist
+        rejected_keys = kwargs.keys() - _TRANSACTION_KWARGS_WHITELIST - set(additional_allowed_keys)
         if rejected_keys:
             raise ValidationError(
                 _("The following kwargs are not whitelisted: %s", ', '.join(rejected_keys))
@@ -0,0 +1,51 @@
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+"""
+Convert the stored Novalnet callback requests to jsonb before `callback_json` becomes a Json field, remove the
+replayed callbacks before they are made unique, and retire the callbacks left pending by the previous versions before
+the callback cron starts executing them.
+"""
+
+# Mirrors `_CALLBACK_MAX_ATTEMPTS` of the callback model, migrations cannot import the module's code
+_CALLBACK_MAX_ATTEMPTS = 5
+
+
+def migrate(cr, version):
+    """ Cast the existing callback requests in place so the ORM does not move the text column aside.
+
+    Callbacks still pending from the previous versions already failed when they were executed inline; they are
+    marked as out of attempts so that the cron does not replay the whole history on its first run.
+
+    :param cursor cr: The database cursor.
+    :param str version: The installed version of the module.
+    """
+    if not version:
+        return
+    cr.execute("""
+        ALTER TABLE novalnet_callback
+        ALTER COLUMN callback_json TYPE jsonb USING callback_json::jsonb
+    """)
+    # Novalnet retries notifications and the previous versions stored every retry; keep one callback per
+    # notification, the processed one if any, so that the unique constraint can be created
+    cr.execute("""
+        DELETE FROM novalnet_callback
+         WHERE id IN (
+            SELECT id
+              FROM (
+                SELECT id, row_number() OVER (
+                           PARTITION BY parent_tid, event_type, check_sum
+                           ORDER BY is_done DESC NULLS LAST, id
+                       ) AS rank
+                  FROM novalnet_callback
+                 WHERE parent_tid IS NOT NULL AND event_type IS NOT NULL AND check_sum IS NOT NULL
+              ) callbacks
+             WHERE rank > 1
+         )
+    """)
+    cr.execute("""
+        ALTER TABLE novalnet_callback
+        ADD COLUMN IF NOT EXISTS attempt_count int4
+    """)
+    cr.execute("""
+        UPDATE novalnet_callback
+           SET attempt_count = CASE WHEN is_done THEN 0 ELSE %s END
+    """, (_CALLBACK_MAX_ATTEMPTS,))
@@ -0,0 +1,41 @@
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+"""
+Convert the formatted instalment cycle amounts to numbers before `cycle_amount` becomes a Monetary field.
+"""
+
+
+def migrate(cr, version):
+    """ Rebuild the cycle amount and its currency from the stored instalment details and transactions.
+
+    The formatted strings cannot be cast, so the amount is taken back from the raw Novalnet instalment
+    details, in minor units, and converted with the decimal places of the transaction currency.
+
+    :param cursor cr: The database cursor.
+    :param str version: The installed version of the module.
+    """
+    if not version:
+        return
+    cr.execute("""
+        ALTER TABLE novalnet_payment_instalment_details
+        ADD COLUMN IF NOT EXISTS currency_id int4
+    """)
+    cr.execute("""
+        UPDATE novalnet_payment_instalment_details instalment
+           SET currency_id = tx.currency_id
+          FROM payment_novalnet_transaction nn_tx
+          JOIN payment_transaction tx ON tx.novalnet_transaction_id = nn_tx.id
+         WHERE nn_tx.novalnet_instalment_information = instalment.id
+    """)
+    cr.execute("""
+        ALTER TABLE novalnet_payment_instalment_details
+        ALTER COLUMN cycle_amount TYPE numeric
+        USING (instalment_all_details->>'cycle_amount')::numeric
+    """)
+    # Instalments without a transaction have no currency to tell their decimal places, two are assumed
+    cr.execute("""
+        UPDATE novalnet_payment_instalment_details instalment
+           SET cycle_amount = instalment.cycle_amount / power(10::numeric, COALESCE(
+               (SELECT currency.decimal_places FROM res_currency currency WHERE currency.id = instalment.currency_id),
+               2))
+         WHERE instalment.cycle_amount IS NOT NULL
+    """)
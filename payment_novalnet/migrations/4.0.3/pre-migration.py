@@ -0,0 +1,21 @@
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+"""
+Convert the Novalnet status code and test mode to their native types before the fields change type.
+"""
+
+
+def migrate(cr, version):
+    """ Cast the stored status codes to integers and the test mode flags to booleans in place.
+
+    :param cursor cr: The database cursor.
+    :param str version: The installed version of the module.
+    """
+    if not version:
+        return
+    cr.execute(r"""
+        ALTER TABLE payment_novalnet_transaction
+        ALTER COLUMN status_code TYPE int4
+            USING CASE WHEN status_code ~ '^\d+$' THEN status_code::int4 END,
+        ALTER COLUMN novalnet_test_mode TYPE bool
+            USING novalnet_test_mode = '1'
+    """)
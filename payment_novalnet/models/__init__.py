@@ -10,3 +10,4 @@ from . import payment_transaction
 from . import payment_novalnet_transaction
 from . import novalnet_callback
 from . import payment_transaction_pay_info
+from . import account_payment_term
@@ -0,0 +1,14 @@
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+"""
+Index the payment term line days looked up for Novalnet due dates
+"""
+from odoo import fields, models
+
+
+class AccountPaymentTermLine(models.Model):
+    """
+     Payment term lines are searched by their number of days whenever a Novalnet due date is applied
+    """
+    _inherit = 'account.payment.term.line'
+
+    nb_days = fields.Integer(index=True)
@@ -3,19 +3,29 @@
 Handling Novalnet Callback
 """
 import datetime
-import json
 import logging
 
-from odoo import _, fields, models
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import ValidationError
-from odoo.http import request
 from odoo.tools import format_amount
 
 from odoo.addons.payment import utils as payment_utils
-from odoo.addons.payment_novalnet.const import RESULT_CODES_MAPPING
+from odoo.addons.payment_novalnet.const import RESULT_CODES_MAPPING, STATE_SETTERS
+from odoo.addons.payment_novalnet.models.payment_transaction import _parse_due_date
 
 _logger = logging.getLogger(__name__)
 
+# Date formats used in the callback comments
+_FMT_DATE = "%d-%m-%Y"
+_FMT_TIME = "%H:%M:%S"
+_FMT_DATETIME = "%d-%m-%Y %H:%M:%S"
+_FMT_DISPLAY = "%b %d, %Y, %I:%M:%S %p"
+
+# Callbacks executed per cron run, the cron triggers itself again while more are pending
+_CALLBACK_BATCH_SIZE = 100
+# Runs after which a callback that still is not done is left for manual review
+_CALLBACK_MAX_ATTEMPTS = 5
+
 _event_selection = [
     ('PAYMENT', 'PAYMENT'),
     ('TRANSACTION_CAPTURE', 'TRANSACTION_CAPTURE'),
@@ -31,6 +41,23 @@ _event_selection = [
     ('SUBMISSION_TO_COLLECTION_AGENCY', 'SUBMISSION_TO_COLLECTION_AGENCY'),
 ]
 
+# Map the callback event types to the name of the method processing them
+_EVENT_HANDLERS = {
+    'CREDIT': '_process_credit',
+    'TRANSACTION_CAPTURE': '_process_capture',
+    'TRANSACTION_CANCEL': '_process_cancel',
+    'TRANSACTION_REFUND': '_process_refund',
+    'CHARGEBACK': '_process_chargeback',
+    'TRANSACTION_UPDATE': '_process_update',
+    'INSTALMENT': '_process_instalment',
+    'INSTALMENT_CANCEL': '_process_instalment_cancel',
+    'PAYMENT_REMINDER_1': '_process_payment_reminder',
+    'PAYMENT_REMINDER_2': '_process_payment_reminder',
+    'SUBMISSION_TO_COLLECTION_AGENCY': '_process_collection_submission',
+}
+_REMINDER_EVENTS = frozenset({'PAYMENT_REMINDER_1', 'PAYMENT_REMINDER_2'})
+_INSTALMENT_PAYMENT_TYPES = frozenset({'INSTALMENT_INVOICE', 'INSTALMENT_DIRECT_DEBIT_SEPA'})
+
 
 class NovalnetTransactionAmountStatus(models.Model):
     """
@@ -68,7 +95,7 @@ class NovalnetCallback(models.Model):
       - transaction_id (Many 2 one): A reference to the associated payment
         transaction, linking to the 'payment.transaction' model. This field
         is read-only.
-      - callback_json (Text): The raw JSON request received from Novalnet,
+      - callback_json (Json): The JSON request received from Novalnet,
         containing callback details. This field is required.
       - is_done (Boolean): Indicates whether the callback has already been
         executed, defaulting to False.
@@ -77,56 +104,69 @@ class NovalnetCallback(models.Model):
     _description = 'Novalnet callback'
 
     event_type = fields.Selection(selection=_event_selection, default='PAYMENT')
-    parent_tid = fields.Char(string='NN Transaction ID of parent transaction ')
-    tid = fields.Char(string='NN Transaction ID ')
+    parent_tid = fields.Char(string='NN Transaction ID of parent transaction ', index=True)
+    tid = fields.Char(string='NN Transaction ID ', index=True)
     check_sum = fields.Char(string='checksum')
 
     transaction_id = fields.Many2one(string="Payment transaction", comodel_name='payment.transaction', readonly=True,
                                      domain='[("provider_id", "=", "provider_id")]', ondelete='restrict')
-    callback_json = fields.Text(string="callback request from novalnet", required=True)
+    callback_json = fields.Json(string="callback request from novalnet", required=True)
     is_done = fields.Boolean(string="Callback Done", help="Whether the callback has already been executed",
-                             default=False)
+                             default=False, index=True)
+    attempt_count = fields.Integer(string="Processing Attempts",
+                                   help="Number of times the cron tried to execute the callback without completing it",
+                                   default=0)
     callback_comment = fields.Char(string='callback comments ')
     current_datetime = fields.Char(string='callback comments date')
 
-    def _process_credit(self, data):
+    _sql_constraints = [
+        ('novalnet_callback_unique', 'unique(parent_tid, event_type, check_sum)', 'Duplicate Novalnet callback'),
+    ]
+
+    def _process_credit(self, data, transaction, instalment, custom):
         """
         Handles the Novalnet callback process for credit events.
         """
         if self.event_type != 'CREDIT':
             return
         _logger.info("Entering in to Novalnt callback credit")
-        converted_amount = payment_utils.to_major_currency_units(data.get('transaction')['amount'],
-                                                                 self.transaction_id.currency_id)
-        formatted_amount = format_amount(self.transaction_id.env, converted_amount, self.transaction_id.currency_id)
+        formatted_amount = self._format_minor_amount(transaction['amount'])
         _credit_msg = _(
             'Credit has been successfully received for the TID: %(parent_tid)s with amount on %(amount)s. Please '
             'refer PAID order details in our Novalnet Admin Portal for the TID: %(child_tid)s',
             parent_tid=self.parent_tid, child_tid=self.tid, amount=formatted_amount
         )
-        converted_amount_formated = payment_utils.to_minor_currency_units(converted_amount,
-                                                                          self.transaction_id.currency_id)
-        # Safely retrieve transaction data
-        transaction = data.get('transaction', {})
         payment_type = transaction.get('payment_type')
         transaction_amount = transaction.get('amount', 0)
         # novalnet transaction amount status table
         paid_amount_status = self.transaction_id.novalnet_transaction_amount_status_id.paid_amount
-        # novalnet transaction table paid amount
-        self.transaction_id.novalnet_transaction_id.paid_amount += data.get('transaction')['amount']
-        credited_amount = self.transaction_id.novalnet_transaction_id.paid_amount
+        # novalnet transaction table paid amount, incremented atomically so that concurrent credit callbacks
+        # for the same TID cannot overwrite each other
+        nn_transaction = self.transaction_id.novalnet_transaction_id
+        credited_amount = None
+        if nn_transaction:
+            nn_transaction.flush_recordset(['paid_amount'])
+            self.env.cr.execute(
+                "UPDATE payment_novalnet_transaction SET paid_amount = COALESCE(paid_amount, 0) + %s "
+                "WHERE id = %s RETURNING paid_amount",
+                (transaction['amount'], nn_transaction.id))
+            row = self.env.cr.fetchone()
+            credited_amount = row and row[0]
+            nn_transaction.invalidate_recordset(['paid_amount'])
+        else:
+            _logger.warning("Novalnet: no transaction details to credit for the TID %s", self.parent_tid)
         # Check state of the transaction once
         is_pending_or_authorized = self.transaction_id.state in {'pending', 'authorized'}
         # Validate conditions and set transaction to done if applicable
         if (payment_type == 'INVOICE_CREDIT' and
-                paid_amount_status >= converted_amount_formated and
+                paid_amount_status >= transaction_amount and
                 is_pending_or_authorized and
                 paid_amount_status == credited_amount):
             self.transaction_id._set_done()
         self._display_callback_comments(_credit_msg)
         self.is_done = True
 
-    def _process_capture(self, data):
+    def _process_capture(self, data, transaction, instalment, custom):
         """
         Handles the Novalnet callback process for capture events.
         """
@@ -134,75 +174,84 @@ class NovalnetCallback(models.Model):
             return
         _logger.info("Entering in to Novalnt callback Capture")
 
-        if self._check_shop_invoked_request(data):
+        if self._check_shop_invoked_request(custom):
             self.is_done = True
             _logger.info("Process already handled in the shop")
             return
+        now = datetime.datetime.now()
         _capture_msg = _(
             'The transaction has been confirmed on %(date)s,%(time)s',
-            date=datetime.datetime.now().strftime("%d-%m-%Y"),
-            time=datetime.datetime.now().strftime("%H:%M:%S")
+            date=now.strftime(_FMT_DATE),
+            time=now.strftime(_FMT_TIME)
         )
-        if self.transaction_id.state in 'authorized':
-            transaction = data.get('transaction', {})
+        if self.transaction_id.state == 'authorized':
             payment_type = transaction.get('payment_type')
-            if payment_type == 'INSTALMENT_INVOICE' or payment_type == 'INSTALMENT_DIRECT_DEBIT_SEPA':
-                instalment_information = data.get('instalment', {})
-                self.transaction_id._validate_instament_details(instalment_information, self.transaction_id.currency_id)
+            if payment_type in _INSTALMENT_PAYMENT_TYPES:
+                self.transaction_id._validate_instament_details(instalment, self.transaction_id.currency_id)
             if transaction.get('due_date') is not None:
-                due_date = datetime.datetime.strptime(data['transaction']['due_date'], '%Y-%m-%d').strftime(
-                    '%d/%m/%Y')
-                self.transaction_id.novalnet_transaction_id.novalnet_due_date = due_date
-                self.transaction_id.set_novalnet_payment_terms(transaction.get('due_date'))
+                due_date, display_due_date = _parse_due_date(transaction['due_date'])
+                self.transaction_id.novalnet_transaction_id.novalnet_due_date = display_due_date
+                self.transaction_id.set_novalnet_payment_terms(due_date)
             self.transaction_id._set_done()
         self._display_callback_comments(_capture_msg)
         self.is_done = True
 
-    def _process_cancel(self, data):
+    def _process_cancel(self, data, transaction, instalment, custom):
         """
         Handles the Novalnet callback process for cancel events.
         """
         if self.event_type != 'TRANSACTION_CANCEL':
             return
         _logger.info("Entering in to Novalnt callback Cancel")
-        if self._check_shop_invoked_request(data):
+        if self._check_shop_invoked_request(custom):
             self.is_done = True
             _logger.info("Process already handled in the shop")
             return
+        now = datetime.datetime.now()
         _cancel_msg = _(
             'The transaction has been canceled on %(datetime)s ',
-            datetime=datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+            datetime=now.strftime(_FMT_DATETIME)
         )
-        if self.transaction_id.state in 'authorized':
+        if self.transaction_id.state == 'authorized':
             self.transaction_id._set_canceled()
         self._display_callback_comments(_cancel_msg)
         self.is_done = True
 
-    def _check_shop_invoked_request(self, data):
+    def _format_minor_amount(self, minor_amount):
+        """
+        Formats an amount sent by Novalnet in minor units for display in the callback comments.
+
+        :param int minor_amount: The amount in minor currency units.
+        :return: The amount in major currency units, formatted in the transaction currency.
+        :rtype: str
+        """
+        currency = self.transaction_id.currency_id
+        return format_amount(self.env, payment_utils.to_major_currency_units(minor_amount, currency), currency)
+
+    def _check_shop_invoked_request(self, custom):
         """
         Checks if the shop has already handled the callback event.
         """
-        if 'custom' in data and 'shop_invoked' in data.get('custom'):
-            return True
-        return False
+        return 'shop_invoked' in custom
 
-    def _process_refund(self, data):
+    def _process_refund(self, data, transaction, instalment, custom):
         """
         Handles the Novalnet callback process for refund events.
         """
         if self.event_type != 'TRANSACTION_REFUND':
             return
         _logger.info("Entering in to Novalnt callback Refund")
-        _shop_invoked = self._check_shop_invoked_request(data)
-        converted_amount = payment_utils.to_major_currency_units(data.get('transaction')['refund']['amount'],
-                                                                 self.transaction_id.currency_id)
-        formatted_amount = format_amount(self.transaction_id.env, converted_amount, self.transaction_id.currency_id)
+        _shop_invoked = self._check_shop_invoked_request(custom)
+        currency = self.transaction_id.currency_id
+        converted_amount = payment_utils.to_major_currency_units(transaction['refund']['amount'], currency)
+        formatted_amount = format_amount(self.env, converted_amount, currency)
         if self.transaction_id.refunds_count > 0:
-            refund_tx_from_source = self.env['payment.transaction'].search(
-                [('source_transaction_id', '=', self.transaction_id.id)], limit=1)
-            refund_tx_from_nn_tid = refund_tx_from_source.filtered(lambda tx: tx.provider_reference == self.tid)
-            if _shop_invoked or (refund_tx_from_nn_tid and
-                                 refund_tx_from_nn_tid[0].provider_reference != self.transaction_id.provider_reference):
+            refund_already_executed = self.env['payment.transaction'].sudo().search_count([
+                ('source_transaction_id', '=', self.transaction_id.id),
+                ('provider_reference', '=', self.tid),
+                ('provider_reference', '!=', self.transaction_id.provider_reference),
+            ], limit=1)
+            if _shop_invoked or refund_already_executed:
                 _logger.info("Callback received for already executed event")
                 self.is_done = True
                 return
@@ -219,37 +268,35 @@ class NovalnetCallback(models.Model):
         self._display_callback_comments(_refund_msg)
         self.is_done = True
 
-    def _process_chargeback(self, data):
+    def _process_chargeback(self, data, transaction, instalment, custom):
         """
         Handles the Novalnet callback process for chargeback events.
         """
         if self.event_type != 'CHARGEBACK':
             return
         _logger.info("Entering in to Novalnt callback Chargeback")
-        converted_amount = payment_utils.to_major_currency_units(data.get('transaction')['amount'],
-                                                                 self.transaction_id.currency_id)
-        formatted_amount = format_amount(self.transaction_id.env, converted_amount, self.transaction_id.currency_id)
+        formatted_amount = self._format_minor_amount(transaction['amount'])
+        now = datetime.datetime.now()
         _chargeback_msg = _(
             'Chargeback executed successfully for the TID: %(parent_tid)s amount: %(amount)s on %(datetime)s . The '
             'subsequent TID: %(child_tid)s',
             parent_tid=self.parent_tid, amount=formatted_amount, child_tid=self.tid,
-            datetime=datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+            datetime=now.strftime(_FMT_DATETIME)
         )
         self._display_callback_comments(_chargeback_msg)
         self.is_done = True
 
-    def _process_update(self, data):
+    def _process_update(self, data, transaction, instalment, custom):
         """
         Handles the Novalnet callback process for transaction update events.
         """
         if self.event_type != 'TRANSACTION_UPDATE':
             return
         _logger.info("Entering in to Novalnt callback TRANSACTION_UPDATE")
-        converted_amount = payment_utils.to_major_currency_units(data.get('transaction')['amount'],
-                                                                 self.transaction_id.currency_id)
-        formatted_amount = format_amount(self.transaction_id.env, converted_amount, self.transaction_id.currency_id)
+        formatted_amount = self._format_minor_amount(transaction['amount'])
+        now = datetime.datetime.now()
 
-        update_type = data.get('transaction')['update_type']
+        update_type = transaction['update_type']
         if update_type == 'AMOUNT_DUE_DATE':
             _update_msg = _(
                 'The transaction has been updated with amount and due date',
@@ -261,119 +308,105 @@ class NovalnetCallback(models.Model):
         elif update_type == 'AMOUNT':
             _update_msg = _(
                 'Transaction amount %(amount)s has been updated successfully on %(datetime)s',
-                amount=formatted_amount, datetime=datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+                amount=formatted_amount, datetime=now.strftime(_FMT_DATETIME)
             )
         elif update_type == 'STATUS':
             _update_msg = _(
                 'Transaction updated successfully for the TID: %(parent_tid)s with the amount %(amount)s on %('
                 'datetime)s ',
                 parent_tid=self.parent_tid, amount=formatted_amount,
-                datetime=datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
+                datetime=now.strftime(_FMT_DATETIME)
             )
-            if 'status' not in data.get('transaction'):
+            status = transaction.get('status')
+            if status is None:
                 self.is_done = True
                 raise ValidationError('Status Not found')
-            state = RESULT_CODES_MAPPING[data.get('transaction')['status']]
+            state = RESULT_CODES_MAPPING.get(status)
+            if state is None:
+                _logger.warning("Unknown Novalnet status %s", status)
+                self.is_done = True
+                return
             if self.transaction_id.state == state:
                 self.is_done = True
                 _logger.info(" Order already in the same state ")
                 return
             if self.transaction_id.state == 'cancel':
                 return
-            if state == 'pending':
-                self.transaction_id._set_pending()
-            elif state == 'authorize':
-                transaction = data.get('transaction', {})
+            if state == 'authorize':
                 _update_msg = _(
                     'The transaction status has been changed from pending to on-hold for the TID: %(parent_tid)s on '
                     '%(date)s &  %(time)s',
                     parent_tid=self.parent_tid, amount=formatted_amount,
-                    date=datetime.datetime.now().strftime("%d-%m-%Y"),
-                    time=datetime.datetime.now().strftime("%H:%M:%S")
+                    date=now.strftime(_FMT_DATE),
+                    time=now.strftime(_FMT_TIME)
                 )
                 if transaction.get('due_date') is not None:
-                    self.transaction_id.set_novalnet_payment_terms(transaction.get('due_date'))
-                self.transaction_id._set_authorized()
+                    self.transaction_id.set_novalnet_payment_terms(_parse_due_date(transaction['due_date'])[0])
             elif state == 'done':
-                transaction = data.get('transaction', {})
                 payment_type = transaction.get('payment_type')
-                if payment_type == 'INSTALMENT_INVOICE' or payment_type == 'INSTALMENT_DIRECT_DEBIT_SEPA':
-                    instalment_information = data.get('instalment', {})
-                    self.transaction_id._validate_instament_details(instalment_information,
-                                                                    self.transaction_id.currency_id)
+                if payment_type in _INSTALMENT_PAYMENT_TYPES:
+                    self.transaction_id._validate_instament_details(instalment, self.transaction_id.currency_id)
                 if transaction.get('due_date') is not None:
-                    due_date = datetime.datetime.strptime(data['transaction']['due_date'], '%Y-%m-%d').strftime(
-                        '%d/%m/%Y')
-                    self.transaction_id.novalnet_transaction_id.novalnet_due_date = due_date
-                    self.transaction_id.set_novalnet_payment_terms(transaction.get('due_date'))
-                self.transaction_id._set_done()
-            elif state == 'cancel':
-                self.transaction_id._set_canceled()
+                    due_date, display_due_date = _parse_due_date(transaction['due_date'])
+                    self.transaction_id.novalnet_transaction_id.novalnet_due_date = display_due_date
+                    self.transaction_id.set_novalnet_payment_terms(due_date)
+            state_setter = STATE_SETTERS.get(state)
+            if state_setter:
+                getattr(self.transaction_id, state_setter)()
         self._display_callback_comments(_update_msg)
         self.is_done = True
 
-    def _process_instalment(self, data):
+    def _process_instalment(self, data, transaction, instalment, custom):
         """
         Handles the Novalnet callback process for instalment events.
         """
         if self.event_type != 'INSTALMENT':
             return
-        converted_amount = payment_utils.to_major_currency_units(data.get('instalment')['cycle_amount'],
-                                                                 self.transaction_id.currency_id)
-        formatted_cycle_amount = format_amount(self.transaction_id.env, converted_amount,
-                                               self.transaction_id.currency_id)
-        instalment_comments_msgs = [
-            _('A new instalment has been received for the Transaction ID: %(parent_tid)s with amount %(cycle_amount)s '
-              'on %(datetime)s. The new instalment transaction ID is: %(child_tid)s\n') % {
-                'parent_tid': self.parent_tid,
-                'cycle_amount': formatted_cycle_amount,
-                'datetime': datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
-                'child_tid': self.tid
+        formatted_cycle_amount = self._format_minor_amount(instalment['cycle_amount'])
+        now = datetime.datetime.now()
+        next_instalment_line = ''
+        if 'next_cycle_date' in instalment:
+            next_instalment_line = _('Next instalment date: %(next_instalment_date)s.\n') % {
+                'next_instalment_date': instalment['next_cycle_date']
             }
-        ]
-
-        if data.get('instalment'):
-            instalment_comments_msgs.append(_('Instalment information:\n'))
-        instalment_comments_msgs.append(_('Current Instalment Cycle: %(current_executed_cycle)s.\n') % {
-            'current_executed_cycle': data.get('instalment')['cycles_executed']
-        })
-        instalment_comments_msgs.append(_('Due instalments: %(due_instalment)s.\n') % {
-            'due_instalment': data.get('instalment')['pending_cycles']
-        })
-        instalment_comments_msgs.append(_('Cycle amount: %(cycle_amount)s.\n') % {
-            'cycle_amount': formatted_cycle_amount
-        })
-        instalment_data = data.get('instalment')
-        if instalment_data and 'next_cycle_date' in instalment_data:
-            instalment_comments_msgs.append(_('Next instalment date: %(next_instalment_date)s.\n') % {
-                'next_instalment_date': data.get('instalment')['next_cycle_date']
-            })
-
-        all_instalment_comments_msg = ''.join(instalment_comments_msgs)
+        all_instalment_comments_msg = _(
+            'A new instalment has been received for the Transaction ID: %(parent_tid)s with amount %(cycle_amount)s '
+            'on %(datetime)s. The new instalment transaction ID is: %(child_tid)s\n'
+            'Instalment information:\n'
+            'Current Instalment Cycle: %(current_executed_cycle)s.\n'
+            'Due instalments: %(due_instalment)s.\n'
+            'Cycle amount: %(cycle_amount)s.\n'
+            '%(next_instalment_line)s') % {
+            'parent_tid': self.parent_tid,
+            'cycle_amount': formatted_cycle_amount,
+            'datetime': now.strftime(_FMT_DATETIME),
+            'child_tid': self.tid,
+            'current_executed_cycle': instalment['cycles_executed'],
+            'due_instalment': instalment['pending_cycles'],
+            'next_instalment_line': next_instalment_line,
+        }
         self._display_callback_comments(all_instalment_comments_msg)
         self.is_done = True
 
-    def _process_instalment_cancel(self, data):
+    def _process_instalment_cancel(self, data, transaction, instalment, custom):
         """
         Handles the Novalnet callback process for instalment cancel events.
         """
         if self.event_type != 'INSTALMENT_CANCEL':
             return
-        if (data.get('instalment')['cancel_type'] == 'ALL_CYCLES' or
-                data.get('instalment')['cancel_type'] == 'REMAINING_CYCLES'):
+        cancel_type = instalment['cancel_type']
+        if cancel_type == 'ALL_CYCLES' or cancel_type == 'REMAINING_CYCLES':
             parent_tid = self.parent_tid or self.tid
+            now = datetime.datetime.now()
             _instalment_cancel_msg = _(
                 'Instalment has been stopped for the TID :  %(parent_tid)s on %(datetime)s',
-                parent_tid=parent_tid, datetime=datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S"))
-            if data.get('instalment')['cancel_type'] == 'ALL_CYCLES':
-                converted_amount = payment_utils.to_major_currency_units(data.get('transaction')['refund']['amount'],
-                                                                         self.transaction_id.currency_id)
-                formatted_amount = format_amount(self.transaction_id.env, converted_amount,
-                                                 self.transaction_id.currency_id)
+                parent_tid=parent_tid, datetime=now.strftime(_FMT_DATETIME))
+            if cancel_type == 'ALL_CYCLES':
+                formatted_amount = self._format_minor_amount(transaction['refund']['amount'])
                 _instalment_cancel_msg = _(
                     'Instalment has been cancelled for the TID: %(parent_tid)s on %(datetime)s & Refund has been '
                     'initiated with the amount %(refund_amount)s',
-                    parent_tid=self.parent_tid, datetime=datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
+                    parent_tid=self.parent_tid, datetime=now.strftime(_FMT_DATETIME),
                     refund_amount=formatted_amount)
                 self.transaction_id._set_canceled(extra_allowed_states=('done',))
             self._display_callback_comments(_instalment_cancel_msg)
@@ -384,7 +417,7 @@ class NovalnetCallback(models.Model):
         Handles the Novalnet callback process for payment reminder events.
         """
 
-        if self.event_type not in ['PAYMENT_REMINDER_1', 'PAYMENT_REMINDER_2']:
+        if self.event_type not in _REMINDER_EVENTS:
             return
         event_type = self.event_type.split('_')
         payment_reminder_no = format(event_type[2])
@@ -393,7 +426,7 @@ class NovalnetCallback(models.Model):
         self._display_callback_comments(_payment_remainder_msg)
         self.is_done = True
 
-    def _process_collection_submission(self, data):
+    def _process_collection_submission(self, data, transaction, instalment, custom):
         """
         Handles the Novalnet callback process for collection submission events.
         """
@@ -406,13 +439,21 @@ class NovalnetCallback(models.Model):
         self._display_callback_comments(_submission_collection_msg)
         self.is_done = True
 
+    @api.model
+    @tools.ormcache()
+    def _get_callback_mail_template_id(self):
+        """
+        Returns the id of the callback mail template, cached to skip the xmlid resolution on every callback.
+        """
+        return self.env.ref('payment_novalnet.novalnet_callback_notification').id
+
     def _send_callback_email(self, comment):
         """
         Handles the send callback process emails.
         """
         if not self.transaction_id.provider_id.novalnet_webhook_send_mail:
             return
-        mail_template = request.env.ref('payment_novalnet.novalnet_callback_notification').sudo()
+        mail_template = self.env['mail.template'].browse(self._get_callback_mail_template_id()).sudo()
         _subject = 'Novalnet odoo callback script'
         _email_to = self.transaction_id.provider_id.novalnet_webhook_send_mail
         _email_from = "no-reply@odoo.com"
@@ -422,43 +463,116 @@ class NovalnetCallback(models.Model):
                                                                     'subject': _subject, })
 
     def _display_callback_comments(self, callback_comments):
-        self.transaction_id._log_message_on_linked_documents(callback_comments)
+        # In batches, the comments are logged on the linked documents once per transaction by `_validate_callbacks`
+        if not self.env.context.get('novalnet_defer_callback_comments'):
+            self.transaction_id._log_message_on_linked_documents(callback_comments)
         self.callback_comment = callback_comments
         get_datetime = fields.Datetime.now()
-        self.current_datetime = get_datetime.strftime('%b %d, %Y, %I:%M:%S %p')
+        self.current_datetime = get_datetime.strftime(_FMT_DISPLAY)
         self._send_callback_email(callback_comments)
 
     def _validate_callback(self):
         """
         Handles the validate Novalnet callback events
         """
+        # Replayed callbacks are already processed, skip them before parsing the payload
+        if self.is_done:
+            return
         if self.event_type == 'PAYMENT':
+            # Communication failure: the customer never returned to the shop, complete the payment from Novalnet
+            if self.transaction_id.state == 'draft':
+                result = self.callback_json.get('result') or {}
+                # The comment deferral only applies to the batch collecting the comments, not to whatever the
+                # transaction processing runs
+                transaction = self.transaction_id.with_context(novalnet_defer_callback_comments=False)
+                transaction._handle_notification_data('novalnet', {
+                    'nn_tid': self.parent_tid, 'nn_status': result.get('status'),
+                    'nn_status_text': result.get('status_text'),
+                })
             self.is_done = True
             return
 
-        data = json.loads(self.callback_json)
+        data = self.callback_json
+        # Extract the sub-dictionaries shared by the handlers once
+        transaction = data.get('transaction') or {}
+        instalment = data.get('instalment') or {}
+        custom = data.get('custom') or {}
         self.tid = data.get('event')['tid']
-        order_lang = data.get('custom')['order_lang']
+        order_lang = custom.get('order_lang')
         if order_lang == 'de_DE':
             self = self.with_context(lang=order_lang)
-        # Dictionary to map event types to processing functions
-        event_handler = {
-            'CREDIT': self._process_credit,
-            'TRANSACTION_CAPTURE': self._process_capture,
-            'TRANSACTION_CANCEL': self._process_cancel,
-            'TRANSACTION_REFUND': self._process_refund,
-            'CHARGEBACK': self._process_chargeback,
-            'TRANSACTION_UPDATE': self._process_update,
-            'INSTALMENT': self._process_instalment,
-            'INSTALMENT_CANCEL': self._process_instalment_cancel,
-            'PAYMENT_REMINDER_1': self._process_payment_reminder,
-            'PAYMENT_REMINDER_2': self._process_payment_reminder,
-            'SUBMISSION_TO_COLLECTION_AGENCY': self._process_collection_submission
-        }
         # Invoke the appropriate handler if the event type matches
-        handler = event_handler.get(self.event_type)
-        if handler:
-            if self.event_type in ['PAYMENT_REMINDER_1', 'PAYMENT_REMINDER_2']:
+        handler_name = _EVENT_HANDLERS.get(self.event_type)
+        if handler_name:
+            handler = getattr(self, handler_name)
+            if self.event_type in _REMINDER_EVENTS:
                 handler()
             else:
-                handler(data)
+                handler(data, transaction, instalment, custom)
+
+    @api.model
+    def _cron_process_pending_callbacks(self):
+        """
+        Process the callbacks stored by the webhook that have not been executed yet.
+
+        The webhook only records the callback so that Novalnet gets its answer without waiting for the
+        processing; each callback is executed in its own savepoint so that one failure does not block the rest.
+        Callbacks are taken in bounded batches and given up after `_CALLBACK_MAX_ATTEMPTS` incomplete runs.
+        """
+        callbacks = self.search(
+            [('is_done', '=', False), ('attempt_count', '<', _CALLBACK_MAX_ATTEMPTS)],
+            order='id', limit=_CALLBACK_BATCH_SIZE)
+        callbacks._validate_callbacks()
+        if len(callbacks) == _CALLBACK_BATCH_SIZE:
+            self.env.ref('payment_novalnet.cron_process_novalnet_callbacks')._trigger()
+
+    def _prefetch_transaction_data(self):
+        """
+        Load the records the callback handlers read into the cache in one query per model.
+
+        Reading one field through the ORM fetches all the stored columns of the records, so the transactions'
+        state and provider reference and the Novalnet details' due date come along with the fields below.
+        """
+        transactions = self.mapped('transaction_id')
+        nn_transactions = transactions.mapped('novalnet_transaction_id')
+        # The payment information note renders the bank, instalment and store details of each transaction
+        nn_transactions.mapped('novalnet_bank_account.iban')
+        nn_transactions.mapped('novalnet_instalment_information.cycle_amount')
+        nn_transactions.mapped('novalnet_nearest_store_ids.store_name')
+        transactions.mapped('currency_id.decimal_places')
+        transactions.mapped('provider_id.novalnet_webhook_send_mail')
+
+    def _count_failed_attempt(self):
+        """ Record a run that did not complete the callback and report it once it is given up. """
+        self.attempt_count += 1
+        if self.attempt_count >= _CALLBACK_MAX_ATTEMPTS:
+            _logger.error("Novalnet: callback %s could not be completed after %s attempts, it is no longer processed",
+                          self.id, self.attempt_count)
+
+    def _validate_callbacks(self):
+        """
+        Handles the validate Novalnet callback events for a batch of callbacks.
+
+        The related records are loaded for the whole batch up front, and the writes done by the handlers are
+        flushed together by the ORM. The comments of the processed callbacks are logged on the linked documents
+        with one message per transaction instead of one per callback.
+        """
+        self._prefetch_transaction_data()
+        comments_by_transaction = {}
+        for callback in self.with_context(novalnet_defer_callback_comments=True):
+            if callback.is_done:
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    callback._validate_callback()
+            except Exception:
+                _logger.exception("Novalnet: could not process callback %s", callback.id)
+                # Counted outside the rolled back savepoint, so that a failing callback is not retried forever
+                callback._count_failed_attempt()
+                continue
+            if not callback.is_done:
+                callback._count_failed_attempt()
+            if callback.callback_comment:
+                comments_by_transaction.setdefault(callback.transaction_id, []).append(callback.callback_comment)
+        for transaction, comments in comments_by_transaction.items():
+            transaction._log_message_on_linked_documents('\n'.join(comments))
@@ -18,16 +18,16 @@ class PaymentTransaction(models.Model):
     _name = 'payment.novalnet.transaction'
     _description = 'Novalnet transaction details'
 
-    tid = fields.Char(string='NN Transaction ID ')
+    tid = fields.Char(string='NN Transaction ID ', index=True)
     payment_type = fields.Char(string="Payment Method Code")
     status = fields.Char(string='Transaction status ')
     payment_name = fields.Char(string='Payment Name')
-    status_code = fields.Char(string='Transaction status_code')
+    status_code = fields.Integer(string='Transaction status_code')
     paid_amount = fields.Integer(default=0)
     refund_amount = fields.Integer(default=0)
     novalnet_txn_secret = fields.Char(string="Transaction secret is a temporary identifier for the payment types with "
                                              "the redirect flow and it travels across the transaction, "
-                                             "useful in verifying the payment result")
+                                             "useful in verifying the payment result", index=True)
     novalnet_bank_account = fields.Many2one('novalnet.payment.transaction.bank', string="Bank details to which "
                                                                                         "customer has to transfer the "
                                                                                         "transaction amount ")
@@ -49,7 +49,7 @@ class PaymentTransaction(models.Model):
                                                                                                     "Instalment "
                                                                                                     "Payments ")
     novalnet_wallet_card_details = fields.Char(string='Wallet Payment Card Details')
-    novalnet_test_mode = fields.Char(string='Novalnet Test Mode')
+    novalnet_test_mode = fields.Boolean(string='Novalnet Test Mode')
     novalnet_cashpayment_token = fields.Text(string='Novalnet Cash Payment token')
     novalnet_cashpayment_js = fields.Char(string='Novalnet Cash Payment JS Script URL')
     zero_amount_check_flag = fields.Char(string='Check Zero Amount Transaction')
@@ -5,12 +5,16 @@
     specific to each provider.
 """
 import base64
+import functools
 import logging
 import pprint
 import re
+from http.cookiejar import DefaultCookiePolicy
+
 import requests
+from requests.adapters import HTTPAdapter
 
-from odoo import _, api, fields, models, service
+from odoo import _, api, fields, models, service, tools
 from odoo.exceptions import ValidationError
 from werkzeug import urls
 
@@ -18,8 +22,50 @@ from odoo.addons.payment import utils as payment_utils
 from odoo.addons.payment_novalnet import const
 from odoo.addons.payment_novalnet.controllers.main import PaymentNovalnetController
 
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import dumps as json_dumps, loads as json_loads
+
 _logger = logging.getLogger(__name__)
 
+# Keep the connections to the Novalnet API alive between requests instead of opening one per call
+_HTTP = requests.Session()
+_HTTP.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=32))
+# The session is shared by every database and merchant of the worker, no cookie may carry over between their calls
+_HTTP.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+# Headers shared by every Novalnet API call, merged into each request by the session
+_HTTP.headers.update({
+    "Content-Type": "application/json",
+    "Charset": "utf-8",
+    "Accept": "application/json",
+    "Connection": "keep-alive",
+})
+
+_NN_BASE_URL = 'https://payport.novalnet.de/v2/'
+# Full URLs of the Novalnet API endpoints called by the module, built once
+_NN_URLS = {
+    endpoint: _NN_BASE_URL + endpoint
+    for endpoint in (
+        'authorize', 'payment', 'merchant/details', 'webhook/configure', 'seamless/payment', 'transaction/details',
+        'transaction/capture', 'transaction/cancel', 'transaction/refund',
+    )
+}
+
+# Novalnet language of the API messages per Odoo language, German being the default
+_NN_LANG = {'en_US': 'EN', 'de_DE': 'DE'}
+
+# Keys of the Novalnet address payload, in the order of the address tuples built from the partners
+_ADDRESS_KEYS = ('city', 'country_code', 'street', 'zip', 'state')
+
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$')
+
+
+@functools.lru_cache(maxsize=1)
+def _odoo_server_version():
+    """ Return the version of the running Odoo server, which does not change for the life of the process. """
+    return service.common.exp_version()['server_version']
+
 
 class NovalnetTariff(models.Model):
     """
@@ -59,7 +105,8 @@ class PaymentProvider(models.Model):
     """
     _inherit = 'payment.provider'
 
-    code = fields.Selection(selection_add=[('novalnet', 'Novalnet')], ondelete={'novalnet': 'set default'})
+    code = fields.Selection(selection_add=[('novalnet', 'Novalnet')], ondelete={'novalnet': 'set default'},
+                            index=True)
     novalnet_product_activation_key = fields.Char(string='Product Activation Key', help='Get your Product activation '
                                                                                         'key from the Novalnet Admin '
                                                                                         'Portal: Projects > Choose '
@@ -70,6 +117,8 @@ class PaymentProvider(models.Model):
                                                                                 'Novalnet Admin Portal: Projects > '
                                                                                 'Choose your project > API '
                                                                                 'credentials > Payment access key')
+    novalnet_payment_access_key_b64 = fields.Char(compute='_compute_novalnet_payment_access_key_b64', store=True)
+    novalnet_system_version = fields.Char(compute='_compute_novalnet_system_version')
     novalnet_traiff = fields.Selection(selection='_get_tariff_options', string='Select Tariff ID', help='Select a '
                                                                                                         'Tariff ID to'
                                                                                                         ' match the '
@@ -93,11 +142,29 @@ class PaymentProvider(models.Model):
         if not self.novalnet_product_activation_key or not self.novalnet_payment_access_key:
             self.hide_novalnet_tariff = False
 
+    # The access key is sent base64-encoded as ASCII, reject anything else when it is saved
+    @api.constrains('novalnet_payment_access_key')
+    def _check_payment_access_key_ascii(self):
+        for provider in self:
+            access_key = provider.novalnet_payment_access_key
+            if access_key and not access_key.isascii():
+                raise ValidationError("Novalnet: " + _("The Payment Access Key contains invalid characters."))
+
+    # Encode the payment access key once for the X-NN-Access-Key header
+    @api.depends('novalnet_payment_access_key')
+    def _compute_novalnet_payment_access_key_b64(self):
+        for provider in self:
+            access_key = provider.novalnet_payment_access_key
+            # Non-ASCII keys are left to `_check_payment_access_key_ascii` to report
+            if access_key and access_key.isascii():
+                provider.novalnet_payment_access_key_b64 = base64.b64encode(access_key.encode("ascii")).decode("ascii")
+            else:
+                provider.novalnet_payment_access_key_b64 = False
+
     # Get tariff id in novalnet.tariff table
     def _get_tariff_options(self):
-        tariff_model = self.env['novalnet.tariff']
-        tariffs = tariff_model.search([])
-        return [(str(tariff.tariff_id), tariff.name) for tariff in tariffs]
+        tariffs = self.env['novalnet.tariff'].search_read([], ['tariff_id', 'name'])
+        return [(str(tariff['tariff_id']), tariff['name']) for tariff in tariffs]
 
     # Generate and Return Webhook URL
     @api.model
@@ -119,14 +186,10 @@ class PaymentProvider(models.Model):
     # Webhook Novalnet mail Validator
     @api.constrains('novalnet_webhook_send_mail')
     def _check_email_format(self):
-        email_regex = r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$'
-        if isinstance(self, models.Model):
-            records = self
-        else:
-            records = self.browse([self.id])
-        for record in records:
-            if record.novalnet_webhook_send_mail and not re.match(email_regex, record.novalnet_webhook_send_mail):
-                raise ValidationError("Email address is not valid.")
+        for record in self:
+            mail = record.novalnet_webhook_send_mail
+            if mail and not _EMAIL_RE.match(mail):
+                raise ValidationError(_("Email address is not valid."))
 
     # Get Merchant Details
     def get_novalnet_merchant_details(self):
@@ -137,20 +200,23 @@ class PaymentProvider(models.Model):
             raise ValidationError("Novalnet: " + _("Mandatory fields are missing"))
         data = {"merchant": {'signature': self.novalnet_product_activation_key}}
         get_merchant_details = self._novalnet_make_request("merchant/details", data=data)
-        if (get_merchant_details.get('result')['status'] == 'SUCCESS' and
-                get_merchant_details.get('result')['status_code'] == 100):
+        merchant_result = get_merchant_details.get('result') or {}
+        if merchant_result.get('status') == 'SUCCESS' and merchant_result.get('status_code') == 100:
+            merchant = get_merchant_details['merchant']
+            merchant_project_id = merchant['project']
+            tariffs = merchant.get('tariff')
+            # The tariffs are replaced as a whole, so clear the table without loading the records
+            tariff_model = self.env['novalnet.tariff']
+            tariff_model.flush_model()
+            self.env.cr.execute("DELETE FROM novalnet_tariff")
+            tariff_model.invalidate_model()
             self.hide_novalnet_tariff = True
-            merchant_project_id = get_merchant_details.get('merchant')['project']
-            check_novalnet_traiff = get_merchant_details.get('merchant')['tariff']
-            self.env['novalnet.tariff'].search([]).unlink()
-            if check_novalnet_traiff:
-                for tariff_id, val in get_merchant_details.get('merchant')['tariff'].items():
-                    create_dict = {'name': val['name'], 'tariff_id': tariff_id, 'tariff_type': val['type'],
-                                   'project_id': merchant_project_id}
-                    self.env['novalnet.tariff'].create(create_dict)
+            if tariffs:
+                tariff_model.create([{'name': val['name'], 'tariff_id': tariff_id, 'tariff_type': val['type'],
+                                      'project_id': merchant_project_id} for tariff_id, val in tariffs.items()])
                 return {'type': 'ir.actions.client', 'tag': 'reload'}
         else:
-            raise ValidationError("Novalnet: " + _(get_merchant_details.get('result')['status_text']))
+            raise ValidationError("Novalnet: " + _(merchant_result.get('status_text')))
 
     # Send Call for Webhook
     def novalnet_webhook_config_btn(self):
@@ -161,8 +227,8 @@ class PaymentProvider(models.Model):
             raise ValidationError("Novalnet: " + _("Mandatory fields are missing"))
         data = {"webhook": {'url': self.novalnet_webhook_url}}
         get_webhook_connect_response = self._novalnet_make_request("webhook/configure", data=data)
-        if get_webhook_connect_response.get('result', {}).get(
-                'status') == 'SUCCESS' and get_webhook_connect_response.get('result', {}).get('status_code') == 100:
+        webhook_result = get_webhook_connect_response.get('result') or {}
+        if webhook_result.get('status') == 'SUCCESS' and webhook_result.get('status_code') == 100:
             return {
                 'type': 'ir.actions.client',
                 'tag': 'display_notification',
@@ -175,7 +241,7 @@ class PaymentProvider(models.Model):
             }
 
         else:
-            raise ValidationError((get_webhook_connect_response.get('result', {}).get('status_text')))
+            raise ValidationError(webhook_result.get('status_text'))
 
     # Override of `payment` to enable additional features.
     def _compute_feature_support_fields(self):
@@ -187,81 +253,75 @@ class PaymentProvider(models.Model):
 
     # Form customer params
     def _create_customer_payload_order(self, order, partner_id):
+        order = order[:1]
         billing_address = order.partner_invoice_id
         shipping_address = order.partner_shipping_id
+        # Load both addresses and their states together rather than one partner and one state at a time
+        (billing_address | shipping_address).mapped('state_id.name')
+        billing = (billing_address.city or None, billing_address.country_id.code or None,
+                   billing_address.street or None, billing_address.zip or None, billing_address.state_id.name or None)
         first_name, last_name = payment_utils.split_partner_name(billing_address.name or partner_id.name)
         customer = {
             'first_name': first_name or last_name,
             'last_name': last_name or first_name,
             'customer_ip': payment_utils.get_customer_ip_address(),
             'customer_no': partner_id.id,
-            'billing': {
-                'city': billing_address.city or None,
-                'country_code': billing_address.country_id.code or None,
-                'street': billing_address.street or None,
-                'zip': billing_address.zip or None,
-                'state': billing_address.state_id.name or None,
-            },
+            'billing': dict(zip(_ADDRESS_KEYS, billing)),
             'shipping': {'same_as_billing': 1},
-            'email': partner_id.email or None,
+            'email': order.partner_id.email or None,
             'phone': partner_id.phone or None,
         }
-        if partner_id.company_name or partner_id.commercial_company_name or billing_address.company_name:
-            customer['billing']['company'] = partner_id.company_name or partner_id.commercial_company_name or billing_address.company_name
-        if len(order) > 1:
-            order = order[0]
-        if not (self.check_address_equal(billing_address, shipping_address)):
-            customer['shipping'] = {
-                'city': shipping_address.city or None,
-                'country_code': shipping_address.country_id.code or None,
-                'street': shipping_address.street or None,
-                'zip': shipping_address.zip or None,
-                'state': shipping_address.state_id.name or None,
-            }
-            if order.partner_shipping_id.company_name or order.partner_shipping_id.commercial_company_name or shipping_address.company_name:
-                customer['shipping'][
-                    'company'] = (order.partner_shipping_id.company_name or
-                                  order.partner_shipping_id.commercial_company_name or shipping_address.company_name)
+        billing_company = (partner_id.company_name or partner_id.commercial_company_name or
+                           billing_address.company_name)
+        if billing_company:
+            customer['billing']['company'] = billing_company
+        shipping = (shipping_address.city or None, shipping_address.country_id.code or None,
+                    shipping_address.street or None, shipping_address.zip or None,
+                    shipping_address.state_id.name or None)
+        if billing != shipping:
+            customer['shipping'] = dict(zip(_ADDRESS_KEYS, shipping))
+            shipping_company = shipping_address.company_name or shipping_address.commercial_company_name
+            if shipping_company:
+                customer['shipping']['company'] = shipping_company
         return customer
 
-    # Function to compare two addresses
-    @staticmethod
-    def check_address_equal(billing, shipping):
-        """
-        Check Billing and Shipping address are equal
-        """
-        return (billing['city'] == shipping['city'] and
-                billing['country_code'] == shipping['country_code'] and
-                billing['street'] == shipping['street'] and
-                billing['zip'] == shipping['zip'] and
-                billing['state_id']['name'] == shipping['state_id']['name'])
-
+    @api.model
+    @tools.ormcache()
     def get_current_theme(self):
         """
         Get Current theme
+
+        The theme modules only change with a module install or upgrade, which resets the registry caches.
         """
         themes = self.env['ir.module.module'].with_context(active_test=True).search([
             ('category_id', 'child_of', self.env.ref('base.module_category_theme').id),
-        ], order='name')
+        ], order='name', limit=1)
+        return themes.name or ''
 
-        theme_name = None  # Initialize theme_name
+    @api.model
+    @tools.ormcache()
+    def _get_novalnet_module_version(self):
+        """
+        Get the installed version of the Novalnet module
 
-        for theme in themes:
-            theme_name = theme.name  # Update theme_name in the loop
-            break  # Exit after the first theme to get the current theme
+        A module upgrade reloads the registry, which clears this cache.
+        """
+        return self.env.ref('base.module_payment_novalnet').installed_version
 
-        return theme_name if theme_name is not None else ''
+    # System version sent with the payments: Odoo version, module version and current theme
+    def _compute_novalnet_system_version(self):
+        module_version = '.'.join(self._get_novalnet_module_version().split('.')[2:])
+        system_version = f'{_odoo_server_version()}-NN{module_version}-NNT{self.get_current_theme()}'
+        for provider in self:
+            provider.novalnet_system_version = system_version
 
     # Form transaction params
     def _create_transaction_order_payload(self, order, currency):
-        odoo_version = service.common.exp_version()['server_version']
-        module = self.env.ref('base.module_payment_novalnet').installed_version
-        module_version = '.'.join(module.split('.')[2:])
         converted_amount = payment_utils.to_minor_currency_units(order.amount_total, currency)
         transaction_payload = {
             'amount': converted_amount,
             'system_name': 'Odoo',
-            'system_version': f'{odoo_version}-NN{module_version}-NNT{self.get_current_theme() or ""}',
+            'system_version': self.novalnet_system_version,
             'currency': currency.name,
             'order_no': order.reference,
             'test_mode': 1 if self.state == 'test' else 0
@@ -270,6 +330,13 @@ class PaymentProvider(models.Model):
 
     # Load payment page and seamless payment call perform
     def _novalnet_load_payment_page(self, order, amount, currency, partner_id):
+        # The email is the one of the partner the customer payload is built from: the order's customer, as the
+        # current user is the public partner in a guest checkout, and the current user only for donations
+        customer_partner = partner_id if order is None else order[:1].partner_id
+        # Novalnet rejects the payment form without these, so don't spend a round-trip to learn it
+        if not (self.novalnet_product_activation_key and self.novalnet_traiff and currency and customer_partner.email):
+            _logger.warning("Novalnet: payment form not loaded for provider %s, mandatory data is missing", self.id)
+            return
         if order is None:
             return self.donation_process(amount, currency, partner_id)
         if order:
@@ -295,8 +362,6 @@ class PaymentProvider(models.Model):
         if not currency:
             return
         converted_amount = payment_utils.to_minor_currency_units(amount, currency)
-        odoo_version = service.common.exp_version()['server_version']
-        module_version = self.env.ref('base.module_payment_novalnet').installed_version
         first_name, last_name = payment_utils.split_partner_name(partner_id.name)
         data = {
             'customer': {
@@ -313,7 +378,7 @@ class PaymentProvider(models.Model):
             'transaction': {
                 'amount': converted_amount,
                 'system_name': 'Odoo',
-                'system_version': f'{odoo_version}-NN{module_version}-NNT{self.get_current_theme() or ""}',
+                'system_version': self.novalnet_system_version,
                 'currency': currency.name,
             },
             'hosted_page': {
@@ -334,10 +399,9 @@ class PaymentProvider(models.Model):
 
     # Override of `payment` to return the default payment method codes.
     def _get_default_payment_method_codes(self):
-        default_codes = super()._get_default_payment_method_codes()
-        if self.code != 'novalnet':
-            return default_codes
-        return const.DEFAULT_PAYMENT_METHOD_CODES
+        if self.code == 'novalnet':
+            return const.DEFAULT_PAYMENT_METHOD_CODES
+        return super()._get_default_payment_method_codes()
 
     # Perform server call
     def _novalnet_make_request(self, endpoint, data=None, method='POST'):
@@ -351,44 +415,43 @@ class PaymentProvider(models.Model):
         :raise: ValidationError if an HTTP error occurs
         """
         self.ensure_one()
-        endpoint = f'/v2/{endpoint.strip("/")}'
-        url = urls.url_join('https://payport.novalnet.de', endpoint)
-        base64_bytes = base64.b64encode(self.novalnet_payment_access_key.encode("ascii"))
-        encoded_data = base64_bytes.decode("ascii")
-        headers = {
-            "Content-Type": "application/json",
-            "Charset": "utf-8",
-            "Accept": "application/json",
-            "X-NN-Access-Key": encoded_data,
-        }
+        url = _NN_URLS.get(endpoint) or _NN_BASE_URL + endpoint.strip('/')
+        encoded_data = self.novalnet_payment_access_key_b64
+        headers = {"X-NN-Access-Key": encoded_data}
         if 'merchant' not in data:
             data['merchant'] = {'signature': self.novalnet_product_activation_key, 'tariff': self.novalnet_traiff}
         if 'custom' not in data:
-            data['custom'] = {'lang': 'EN' if self.env.context.get('lang') == 'en_US' else 'DE'}
+            data['custom'] = {'lang': _NN_LANG.get(self.env.context.get('lang'), 'DE')}
         try:
-            _logger.info(
-                "novalnet payment transfer request\nURL: %(url)s\nPayload: %(values)s",
-                {'url': url, 'values': pprint.pformat(data)},
-            )
-            response = requests.request(method, url, json=data, headers=headers, timeout=60)
-            result = response.json()
-            _logger.info(
-                "novalnet payment transfer response "
-                "\n%(values)s",
-                {'values': pprint.pformat(result)},
-            )
+            # pformat walks the whole payload, only pay for it when the message is actually logged
+            log_payloads = _logger.isEnabledFor(logging.INFO)
+            if log_payloads:
+                _logger.info(
+                    "novalnet payment transfer request\nURL: %(url)s\nPayload: %(values)s",
+                    {'url': url, 'values': pprint.pformat(data)},
+                )
+            response = _HTTP.request(method, url, data=json_dumps(data), headers=headers, timeout=60)
             if response.status_code == 204:
-                return True  # returned no content
-            if response.status_code not in [200]:
+                # Every caller reads the response body, an empty answer is a failed communication
+                _logger.error("Empty response from Novalnet: %s", url)
+                raise ValidationError("novalnet: " + _("Could not establish the connection to the API."))
+            if response.status_code != 200:
                 error_msg = f"Error[{response.status_code}]"
-                _logger.exception("Error from Novalnet: %s", result)
+                _logger.error("Error from Novalnet: %s", response.text)
                 raise ValidationError("novalnet: " + _(error_msg))
-            response.raise_for_status()
-        except requests.exceptions.RequestException:
+            result = json_loads(response.content)
+            if log_payloads:
+                _logger.info(
+                    "novalnet payment transfer response "
+                    "\n%(values)s",
+                    {'values': pprint.pformat(result)},
+                )
+        except (requests.exceptions.RequestException, ValueError):
             _logger.exception("Unable to communicate with novalnet: %s", url)
             raise ValidationError("novalnet: " + _("Could not establish the connection to the API."))
-        if result.get('result')['status'] == 'FAILURE':
-            error_msg = (f"Error[{result.get('result')['status']}] : "
-                         f"{result.get('result')['status_code']} - {result.get('result')['status_text']}")
+        response_result = result.get('result') or {}
+        status = response_result.get('status')
+        if status == 'FAILURE':
+            error_msg = f"Error[{status}] : {response_result.get('status_code')} - {response_result.get('status_text')}"
             raise ValidationError("novalnet: " + _(error_msg))
         return result
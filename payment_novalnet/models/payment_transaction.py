@@ -2,24 +2,119 @@
 This file is used for Novalnet Payment Transaction Process
 """
 
+import functools
 import logging
 import re
 import socket
-from datetime import datetime, timedelta
-from ipaddress import ip_interface
+import time
+from datetime import date, datetime, timedelta
 
-from odoo import _, fields, models, service
+from lxml import html as lxml_html
+from markupsafe import Markup
+from psycopg2.errors import UniqueViolation
+
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import UserError, ValidationError
 from odoo.http import request
-from odoo.tools import format_amount
+from odoo.tools import format_amount, html_sanitize
 from werkzeug import urls
 
 from odoo.addons.payment import utils as payment_utils
-from odoo.addons.payment_novalnet.const import RESULT_CODES_MAPPING
+from odoo.addons.payment_novalnet.const import STATUS_ACTIONS
 from odoo.addons.payment_novalnet.controllers.main import PaymentNovalnetController
+from odoo.addons.payment_novalnet.models.payment_provider import _odoo_server_version
+from odoo.addons.payment_novalnet.models.payment_transaction_pay_info import _bank_key_hash
 
 _logger = logging.getLogger(__name__)
 
+# Payment form values forwarded as the payment data of the transaction
+_PAYMENT_DATA_KEYS = ('token', 'pan_hash', 'unique_id', 'iban', 'wallet_token', 'bic')
+
+# Bank details fields required to store the account the customer has to transfer to
+_BANK_REQUIRED = frozenset(('account_holder', 'bank_name', 'bank_place', 'bic', 'iban'))
+
+# Format of the due dates displayed to the customer
+_DUE_DATE_DISPLAY_FMT = '%d/%m/%Y'
+
+# Novalnet statuses of a successful capture
+_CAPTURE_OK_STATUSES = frozenset({'CONFIRMED', 'PENDING'})
+
+# Class marking the Novalnet payment information block in the sale order notes, so that it can be replaced
+_NOTE_BLOCK_CLASS = 'o_novalnet_payment_information'
+
+# Resolved Novalnet hosts as {host: (ip, expiry)}, expiry being a `time.monotonic` timestamp
+_DNS_CACHE = {}
+
+
+def _resolve_cached(host, ttl=300):
+    """ Resolve a host name, reusing the answer for `ttl` seconds.
+
+    When the resolver fails, the last known address is used rather than rejecting the webhook.
+
+    :param str host: The host name to resolve.
+    :param int ttl: How long a resolved address is reused, in seconds.
+    :return: The IPv4 address of the host.
+    :rtype: str
+    """
+    now = time.monotonic()
+    cached = _DNS_CACHE.get(host)
+    if cached and cached[1] > now:
+        return cached[0]
+    try:
+        ip = socket.gethostbyname(host)
+    except OSError:
+        if cached:
+            _logger.warning("Novalnet: could not resolve %s, using the last known address", host)
+            return cached[0]
+        raise
+    _DNS_CACHE[host] = (ip, now + ttl)
+    return ip
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_due_date(due_date):
+    """ Parse a Novalnet due date once for both the payment terms and the displayed value.
+
+    :param str due_date: The due date as sent by Novalnet, in ISO format (YYYY-MM-DD).
+    :return: The parsed date and its display value (DD/MM/YYYY).
+    :rtype: tuple
+    """
+    due_date_obj = date.fromisoformat(due_date)
+    return due_date_obj, due_date_obj.strftime(_DUE_DATE_DISPLAY_FMT)
+
+
+def _replace_novalnet_note_block(note, block):
+    """ Replace the Novalnet payment information block of a note, or append it when the note has none yet.
+
+    :param str note: The current note, possibly empty.
+    :param str block: The payment information, wrapped in an element of class `_NOTE_BLOCK_CLASS`.
+    :return: The note holding `block` once.
+    :rtype: str
+    """
+    if not note:
+        return block
+    root = lxml_html.fragment_fromstring(note, create_parent='div')
+    for node in root.find_class(_NOTE_BLOCK_CLASS):
+        node.drop_tree()
+    remaining = (root.text or '') + ''.join(lxml_html.tostring(child, encoding='unicode') for child in root)
+    return remaining + ' \n ' + block if remaining.strip() else block
+
+
+def _packed_ip(ip):
+    """ Pack an IP address into its binary form, so that two addresses compare as plain bytes.
+
+    :param str ip: The IPv4 or IPv6 address.
+    :return: The packed address, or None if `ip` is not a valid address.
+    :rtype: bytes
+    """
+    try:
+        return socket.inet_aton(ip)
+    except OSError:
+        try:
+            return socket.inet_pton(socket.AF_INET6, ip)
+        except OSError:
+            return None
+
 
 class PaymentTransaction(models.Model):
     """
@@ -30,11 +125,23 @@ class PaymentTransaction(models.Model):
     # 'novalnet_transaction_id must be unique to ensure one2one relationship')]
     capture_manually = fields.Boolean(related='provider_id.capture_manually')
     novalnet_transaction_id = fields.Many2one(string="Novalnet transaction details",
-                                              comodel_name='payment.novalnet.transaction')
+                                              comodel_name='payment.novalnet.transaction', index=True)
     novalnet_callback_ids = fields.One2many(string="Novalnet transaction callback details",
                                             comodel_name='novalnet.callback', inverse_name='transaction_id')
     novalnet_transaction_amount_status_id = fields.Many2one('novalnet.transaction.amount.status',
                                                             string=" Novalnet transaction amount status ")
+    is_novalnet = fields.Boolean(compute='_compute_is_novalnet', store=True, index=True)
+
+    @api.depends('provider_code')
+    def _compute_is_novalnet(self):
+        for tx in self:
+            tx.is_novalnet = tx.provider_code == 'novalnet'
+
+    def init(self):
+        super().init()
+        # Used to detect refund callbacks that were already executed for a source transaction
+        tools.create_index(self._cr, 'payment_transaction_source_provider_reference_index', self._table,
+                           ['source_transaction_id', 'provider_reference'])
 
     def action_novalnet_set_done(self):
         """ Set the state of the novalnet transaction to 'done'.
@@ -44,7 +151,7 @@ class PaymentTransaction(models.Model):
         :return: None
         """
         self.ensure_one()
-        if self.provider_code != 'novalnet':
+        if not self.is_novalnet:
             return
 
         notification_data = {'reference': self.reference, 'simulated_state': 'done'}
@@ -58,7 +165,7 @@ class PaymentTransaction(models.Model):
         :return: None
         """
         self.ensure_one()
-        if self.provider_code != 'novalnet':
+        if not self.is_novalnet:
             return
 
         notification_data = {'reference': self.reference, 'simulated_state': 'cancel'}
@@ -72,7 +179,7 @@ class PaymentTransaction(models.Model):
         :return: None
         """
         self.ensure_one()
-        if self.provider_code != 'novalnet':
+        if not self.is_novalnet:
             return
 
         notification_data = {'reference': self.reference, 'simulated_state': 'error'}
@@ -86,7 +193,7 @@ class PaymentTransaction(models.Model):
         :return: None
         """
         super()._send_payment_request()
-        if self.provider_code != 'novalnet':
+        if not self.is_novalnet:
             return
 
         if not self.token_id:
@@ -98,7 +205,7 @@ class PaymentTransaction(models.Model):
 
     def _send_refund_request(self, **kwargs):
         refund_tx = super()._send_refund_request(**kwargs)
-        if self.provider_code != 'novalnet':
+        if not self.is_novalnet:
             return refund_tx
         converted_amount = payment_utils.to_minor_currency_units(refund_tx.amount, refund_tx.currency_id)
         refund_payload = {
@@ -144,7 +251,7 @@ class PaymentTransaction(models.Model):
          Novalnet transaction capture process
         """
         child_capture_tx = super()._send_capture_request(amount_to_capture=amount_to_capture)
-        if self.provider_code != 'novalnet':
+        if not self.is_novalnet:
             return child_capture_tx
 
         tx = child_capture_tx or self
@@ -160,11 +267,13 @@ class PaymentTransaction(models.Model):
         }
 
         capture_response = tx.provider_id._novalnet_make_request("transaction/capture", data=capture_payload)
-        if capture_response['transaction']['status'] in ['CONFIRMED', 'PENDING']:
+        if capture_response['transaction']['status'] in _CAPTURE_OK_STATUSES:
+            # A single timestamp, so that the date and the time cannot straddle midnight
+            now = datetime.now()
             _portal_comments = _(
                 'The transaction has been confirmed on %(date)s,%(time)s',
-                date=datetime.now().strftime("%d-%m-%Y"),
-                time=datetime.now().strftime("%H:%M:%S")
+                date=now.strftime("%d-%m-%Y"),
+                time=now.strftime("%H:%M:%S")
             )
 
         else:
@@ -178,7 +287,7 @@ class PaymentTransaction(models.Model):
           Novalnet transaction cancel process
         """
         child_void_tx = super()._send_void_request(amount_to_void=amount_to_void)
-        if self.provider_code != 'novalnet':
+        if not self.is_novalnet:
             return child_void_tx
 
         tx = child_void_tx or self
@@ -204,15 +313,6 @@ class PaymentTransaction(models.Model):
                                       'nn_status': 'DEACTIVATED'})
         return child_void_tx
 
-    def _execute_callback(self):
-        """
-        This function for validate Novalnet Callback
-        """
-        if self.provider_code != 'novalnet':
-            return
-        for nn_callback in self.novalnet_callback_ids.filtered(lambda t: not t.is_done):
-            nn_callback._validate_callback()
-
     def _get_tx_from_notification_data(self, provider_code, notification_data):
         """ Override of payment to find the transaction based on dummy data.
 
@@ -227,7 +327,7 @@ class PaymentTransaction(models.Model):
             return tx
 
         reference = notification_data.get('reference')
-        tx = self.search([('reference', '=', reference), ('provider_code', '=', 'novalnet')])
+        tx = self.search([('reference', '=', reference), ('is_novalnet', '=', True)])
         if not tx:
             raise ValidationError(
                 "Novalnet: " + _("No transaction found matching reference %s.", reference)
@@ -244,17 +344,20 @@ class PaymentTransaction(models.Model):
         :raise: ValidationError if inconsistent data were received
         """
         super()._process_notification_data(notification_data)
-        if self.provider_code != 'novalnet':
+        if not self.is_novalnet:
             return
 
         if 'event_type' in notification_data:
             self._initiate_transaction_callback(notification_data)
+            # Process the stored callback outside of the webhook request: the callbacks are only executed by this
+            # cron, the core `_execute_callback` run after this method does not touch them.
+            self.env.ref('payment_novalnet.cron_process_novalnet_callbacks')._trigger()
+            # A PAYMENT callback for a draft transaction (communication failure) is completed by the cron as well,
+            # so that the transaction details request does not hold up the answer to Novalnet.
             if notification_data.get('event_type') == 'PAYMENT' and self.state != 'draft':
                 _logger.info(_("Callback received for event type %s but communication failure not found",
                                notification_data.get('event_type')))
-                return
-            elif notification_data.get('event_type') != 'PAYMENT':
-                return
+            return
 
         if not notification_data.get('nn_tid'):
             raise ValidationError(_("Invalid transaction"))
@@ -262,13 +365,14 @@ class PaymentTransaction(models.Model):
         # Save the transaction ID (tid) for Redirect Payments.
         self.provider_reference = notification_data.get('nn_tid')
 
-        if 'nn_status' in notification_data:
-            if notification_data.get('nn_status') == 'FAILURE':
-                self._set_error(notification_data.get('nn_status_text'))
-                return
-            elif notification_data.get('nn_status') == 'DEACTIVATED':
-                self._set_canceled()
-                return
+        # Final statuses reported with the notification need no transaction details from Novalnet
+        nn_status = notification_data.get('nn_status')
+        if nn_status == 'FAILURE':
+            self._set_error(notification_data.get('nn_status_text'))
+            return
+        elif nn_status == 'DEACTIVATED':
+            self._set_canceled()
+            return
 
         retrieve_transaction = self.provider_id._novalnet_make_request("transaction/details", data={
             'transaction': {'tid': notification_data.get('nn_tid')},
@@ -286,7 +390,7 @@ class PaymentTransaction(models.Model):
         if 'instalment' in retrieve_transaction and 'cycles_executed' in retrieve_transaction['instalment']:
             self._validate_instament_details(retrieve_transaction['instalment'], self.currency_id)
 
-        state = RESULT_CODES_MAPPING[transaction_data['status']]
+        state, state_setter = STATUS_ACTIONS[transaction_data['status']]
         converted_amount = payment_utils.to_minor_currency_units(self.amount, self.currency_id)
         _novalnet_transaction_dict = {
             'paid_amount': converted_amount,
@@ -306,31 +410,35 @@ class PaymentTransaction(models.Model):
             if transaction_data['payment_type'] != 'PREPAYMENT' and transaction_data['status_code'] == 100:
                 state = 'done'
 
-        if not self.novalnet_transaction_id:
-            _logger.warning("Novalnet transaction details Not found")
-            self.novalnet_transaction_id = self.env['payment.novalnet.transaction'].create(_novalnet_transaction_dict)
-        else:
-            self.novalnet_transaction_id.write(_novalnet_transaction_dict)
-
-        # Handle nearest stores and multibanco payment info only if 'transaction' is present
+        # The cash payment, multibanco and wallet details go into the same create or write as the status, rather
+        # than one UPDATE per field once the Novalnet details exist
         if 'nearest_stores' in transaction_data:
-            self._validate_create_store_info_for_cashpayment(transaction_data['nearest_stores'])
-            self.novalnet_transaction_id.novalnet_cashpayment_token = transaction_data['checkout_token']
-            self.novalnet_transaction_id.novalnet_cashpayment_js = (transaction_data['checkout_js'] + '?token=' +
-                                                                    transaction_data['checkout_token'])
+            _novalnet_transaction_dict['novalnet_cashpayment_token'] = transaction_data['checkout_token']
+            _novalnet_transaction_dict['novalnet_cashpayment_js'] = (transaction_data['checkout_js'] + '?token=' +
+                                                                     transaction_data['checkout_token'])
 
         if {'partner_payment_reference', 'service_supplier_id'} <= set(transaction_data):
-            self._validate_create_multibanco_payment_info(
+            _novalnet_transaction_dict.update(self._get_multibanco_payment_info_vals(
                 transaction_data['partner_payment_reference'],
                 transaction_data['service_supplier_id']
-            )
+            ))
 
         if ('payment_data' in transaction_data and 'card_number' in transaction_data['payment_data']):
-            self.novalnet_transaction_id.novalnet_wallet_card_details = (
+            _novalnet_transaction_dict['novalnet_wallet_card_details'] = (
                     transaction_data['payment_data']['card_brand'] + ' ' +
                     transaction_data['payment_data']['card_number']
             )
 
+        if not self.novalnet_transaction_id:
+            _logger.warning("Novalnet transaction details Not found")
+            self.novalnet_transaction_id = self.env['payment.novalnet.transaction'].create(_novalnet_transaction_dict)
+        else:
+            self.novalnet_transaction_id.write(_novalnet_transaction_dict)
+
+        # The stores link to the Novalnet details, which exist from here on
+        if 'nearest_stores' in transaction_data:
+            self._validate_create_store_info_for_cashpayment(transaction_data['nearest_stores'])
+
         _transaction_amount_dict = {
             'paid_amount': converted_amount,
         }
@@ -338,27 +446,21 @@ class PaymentTransaction(models.Model):
             _transaction_amount_dict)
 
         # Update the payment state based on the transaction status
-        if state == 'pending':
-            self._set_pending()
-        elif state == 'authorize':
-            self._set_authorized()
-        elif state == 'done':
-            self._set_done()
-            # Immediately post-process the transaction if it is a refund, as the post-processing
-            # will not be triggered by a customer browsing the transaction from the portal.
-            if self.operation == 'refund':
-                self.env.ref('payment.cron_post_process_payment_tx')._trigger()
-        elif state == 'cancel':
-            self._set_canceled()
-        else:  # Simulate an error state.
+        if not state_setter:  # Simulate an error state.
             self._set_error(_("You selected the following novalnet payment status: %s", state))
+            return
+        getattr(self, state_setter)()
+        # Immediately post-process the transaction if it is a refund, as the post-processing
+        # will not be triggered by a customer browsing the transaction from the portal.
+        if state == 'done' and self.operation == 'refund':
+            self.env.ref('payment.cron_post_process_payment_tx')._trigger()
 
     def _initiate_transaction_callback(self, notification_data):
         """
         This function for initiate Novalnet callback
         """
-        nn_ip = ip_interface(socket.gethostbyname('pay-nn.de'))
-        request_ip = ip_interface(payment_utils.get_customer_ip_address())
+        nn_ip = _packed_ip(_resolve_cached('pay-nn.de'))
+        request_ip = _packed_ip(payment_utils.get_customer_ip_address())
         if not (nn_ip and request_ip):
             raise ValidationError(_('Unauthorized access: Missing Host or Received IP'))
         if nn_ip != request_ip and not self.provider_id.novalnet_allow_manual_testing:
@@ -366,72 +468,79 @@ class PaymentTransaction(models.Model):
         if 'event_type' not in notification_data or 'check_sum' not in notification_data:
             raise ValidationError(_("Could not initiate callback"))
 
-        self.write({
-            'novalnet_callback_ids': [(0, 0, {
-                'event_type': notification_data.get('event_type'),
-                'parent_tid': notification_data.get('nn_tid'),
-                'check_sum': notification_data.get('check_sum'),
-                'transaction_id': self.id,
-                'callback_json': request.httprequest.data
-            })],
-        })
+        try:
+            # Novalnet retries notifications, the unique constraint makes a replayed one a no-op. The savepoint
+            # flushes the insert when it exits, so it is entered within the muted logger
+            with tools.mute_logger('odoo.sql_db'), self.env.cr.savepoint():
+                self.env['novalnet.callback'].create({
+                    'event_type': notification_data.get('event_type'),
+                    'parent_tid': notification_data.get('nn_tid'),
+                    'check_sum': notification_data.get('check_sum'),
+                    'transaction_id': self.id,
+                    'callback_json': notification_data.get('nn_callback_data'),
+                })
+        except UniqueViolation:
+            _logger.info("Novalnet: duplicate %s callback received for the TID %s",
+                         notification_data.get('event_type'), notification_data.get('nn_tid'))
 
     def _set_pending(self):
         """
         Sets the current state to pending
         """
         super()._set_pending()
-        if self.provider_code != 'novalnet':
+        if not self.is_novalnet:
             return
-        lang = self.novalnet_transaction_id.nn_lang or self.partner_id.lang or request.env.user.lang
-        for order in self.sale_order_ids:
-            order.write(
-                {'note': order.note + ' \n ' + self.env['ir.ui.view'].sudo().with_context(lang=lang)._render_template(
-                    "payment_novalnet.novalnet_payment_information",
-                    {'tx_sudo': self.with_context(lang=lang), 'order': order}
-                )})
+        self._append_novalnet_note_to_orders()
 
     def _set_authorized(self):
         """
         Sets the current state to authorized
         """
         super()._set_authorized()
-        if self.provider_code != 'novalnet':
+        if not self.is_novalnet:
             return
-        lang = self.novalnet_transaction_id.nn_lang or self.partner_id.lang or request.env.user.lang
-        for order in self.sale_order_ids:
-            order.write({'note': order.note + ' \n ' + self.env['ir.ui.view'].with_context(lang=lang)._render_template(
-                "payment_novalnet.novalnet_payment_information",
-                {'tx_sudo': self.with_context(lang=lang), 'order': order}
-            )})
+        self._append_novalnet_note_to_orders()
 
     def _set_done(self):
         """
         Sets the current state to done
         """
         super()._set_done()
-        if self.provider_code != 'novalnet':
+        if not self.is_novalnet:
             return
-        lang = self.novalnet_transaction_id.nn_lang or self.partner_id.lang or request.env.user.lang
-        for order in self.sale_order_ids:
-            order.write(
-                {'note': order.note + ' \n ' + self.env['ir.ui.view'].sudo().with_context(lang=lang)._render_template(
-                    "payment_novalnet.novalnet_payment_information",
-                    {'tx_sudo': self.with_context(lang=lang), 'order': order}
-                )})
+        self._append_novalnet_note_to_orders()
 
     def _set_error(self, error_text):
         """ Update the transactions' state to `error`."""
         super()._set_error(error_text)
-        if self.provider_code != 'novalnet':
+        if not self.is_novalnet:
             return
-        lang = self.novalnet_transaction_id.nn_lang or self.partner_id.lang or request.env.user.lang
+        self._append_novalnet_note_to_orders()
+
+    def _append_novalnet_note_to_orders(self):
+        """
+        Append the Novalnet payment information to the notes of the linked sale orders
+
+        The template only depends on the order through its currencies, so it is rendered once per distinct pair of
+        currencies rather than once per order. The information of a previous state is replaced, not appended again.
+        """
+        lang = self.novalnet_transaction_id.nn_lang or self.partner_id.lang or self.env.user.lang
+        view = self.env['ir.ui.view'].sudo().with_context(lang=lang)
+        # The view id comes from the ormcache and QWeb keeps the compiled template per id, so no xml id is resolved
+        # through `ir.model.data` on each state change
+        template_id = self.env['ir.model.data']._xmlid_to_res_id('payment_novalnet.novalnet_payment_information')
+        tx_sudo = self.with_context(lang=lang)
+        rendered_notes = {}
         for order in self.sale_order_ids:
-            order.write(
-                {'note': order.note + ' \n ' + self.env['ir.ui.view'].sudo().with_context(lang=lang)._render_template(
-                    "payment_novalnet.novalnet_payment_information",
-                    {'tx_sudo': self.with_context(lang=lang), 'order': order}
-                )})
+            currencies = (order.currency_id, order.pricelist_id.currency_id)
+            if currencies not in rendered_notes:
+                rendered_notes[currencies] = Markup('<div class="%s">%s</div>') % (
+                    _NOTE_BLOCK_CLASS, view._render_template(template_id, {'tx_sudo': tx_sudo, 'order': order}))
+            # Sanitized like the stored Html note, so that an unchanged note is not written again
+            note = html_sanitize(_replace_novalnet_note_block(str(order.note or ''), rendered_notes[currencies]))
+            if str(note) == str(order.note or ''):
+                continue
+            order.write({'note': note})
 
     def _create_customer_payload(self, notification_data):
         """ Prepare customer data """
@@ -452,51 +561,55 @@ class PaymentTransaction(models.Model):
             'email': self.partner_email or None,
             'phone': self.partner_phone or None,
         }
-        order = None
-        if len(self.sale_order_ids) == 1:
-            order = self.sale_order_ids[0]
+        # An empty recordset rather than None, so that the order fields below read as False without an order
+        order = self.sale_order_ids if len(self.sale_order_ids) == 1 else self.env['sale.order']
 
         partner = request.env.user.partner_id
-        if partner.company_name or partner.commercial_company_name or order.partner_invoice_id.company_name:
-            customer['billing']['company'] = partner.company_name or partner.commercial_company_name or order.partner_invoice_id.company_name
+        company = partner.company_name or partner.commercial_company_name or order.partner_invoice_id.company_name
+        if company:
+            customer['billing']['company'] = company
 
-        if order and self.partner_id.id != order.partner_shipping_id.id:
+        shipping_partner = order.partner_shipping_id
+        if order and self.partner_id.id != shipping_partner.id:
             customer['shipping'] = {
-                'street': order.partner_shipping_id.street,
-                'state': order.partner_shipping_id.state_id.name or None,
-                'city': order.partner_shipping_id.city,
-                'zip': order.partner_shipping_id.zip,
-                'country_code': order.partner_shipping_id.country_id.code,
+                'street': shipping_partner.street,
+                'state': shipping_partner.state_id.name or None,
+                'city': shipping_partner.city,
+                'zip': shipping_partner.zip,
+                'country_code': shipping_partner.country_id.code,
             }
-            if order.partner_shipping_id.company_name or order.partner_shipping_id.commercial_company_name:
-                customer['shipping']['company'] = \
-                    (order.partner_shipping_id.company_name or order.partner_shipping_id.commercial_company_name)
-        if 'pay_data' in notification_data and 'birth_date' in notification_data['pay_data']:
-            customer['birth_date'] = notification_data['pay_data']['birth_date']
+            shipping_company = shipping_partner.company_name or shipping_partner.commercial_company_name
+            if shipping_company:
+                customer['shipping']['company'] = shipping_company
+        paydata = notification_data.get('pay_data') or {}
+        if 'birth_date' in paydata:
+            customer['birth_date'] = paydata['birth_date']
         return customer
 
     def _compute_due_date_from_terms(self):
         """ Compute due date from the payment terms.
         :return: duedate
         """
-        im_payment_terms = payment_term_id = self.env.ref('account.account_payment_term_immediate', False).sudo()
+        # Only the id is needed, `_xmlid_to_res_id` is served from the ormcache without loading the record
+        immediate_term_id = self.env['ir.model.data']._xmlid_to_res_id('account.account_payment_term_immediate')
+        payment_term_id = self.env['account.payment.term']
         if len(self.sale_order_ids) > 0:
             if len(self.sale_order_ids) > 1:
                 _logger.warning(
                     "Novalnet: More than one payment transaction assigned to sale.order '%s', so mapping the "
                     "sale.order to the transaction via transaction reference",
                     self.sale_order_ids)
-            sale_order = self.sale_order_ids.filtered(lambda so: so.name == self.reference)
+            sale_order = self.sale_order_ids.filtered_domain([('name', '=', self.reference)])
             if sale_order:
                 payment_term_id = sale_order.payment_term_id
 
         if len(self.invoice_ids) > 0:
-            if len(self.sale_order_ids) > 1:
+            if len(self.invoice_ids) > 1:
                 _logger.warning(
                     "Novalnet: More than one payment transaction assigned to account.move '%s', so mapping the "
                     "account.move to the transaction via transaction reference ",
-                    self.sale_order_ids)
-            inv = self.invoice_ids.filtered(lambda inv: inv.name == self.reference)
+                    self.invoice_ids)
+            inv = self.invoice_ids.filtered_domain([('name', '=', self.reference)])
             if inv and inv.invoice_payment_term_id:
                 payment_term_id = inv.invoice_payment_term_id
             elif inv and inv.invoice_date_due:
@@ -506,26 +619,25 @@ class PaymentTransaction(models.Model):
                     _logger.warning("Could not convert invoice due-date")
 
         # check payment terms
-        if payment_term_id and im_payment_terms.id != payment_term_id.id:
-            due_date = datetime.today()
-            for term_line in payment_term_id.line_ids:
-                if term_line.nb_days:
-                    due_date += timedelta(days=term_line.nb_days)
-                else:
-                    _logger.warning("Term line does not have a 'days' value: %s", term_line)
+        if payment_term_id and payment_term_id.id != immediate_term_id:
+            term_days = payment_term_id.line_ids.mapped('nb_days')
+            if not all(term_days):
+                _logger.warning("Term lines of %s do not all have a 'days' value", payment_term_id)
+            due_date = datetime.today() + timedelta(days=sum(term_days))
             return due_date.strftime('%Y-%m-%d')
         return False
 
     def set_novalnet_payment_terms(self, server_due_date):
-        sale_order = inv = payment_term = None
-        sale_order = self.sale_order_ids.filtered(lambda so: so.name == self.reference)
-        inv = self.invoice_ids.filtered(lambda inv: inv.name == self.reference)
-        current_date = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        server_due_date_obj = datetime.strptime(server_due_date, '%Y-%m-%d').replace(hour=0, minute=0, second=0,
-                                                                                     microsecond=0)
-        date_difference = (server_due_date_obj - current_date).days
-        payment_term = self.env['account.payment.term'].search([('line_ids.nb_days', '=', date_difference)],
-                                                               limit=1)
+        """ Apply a payment term matching the Novalnet due date to the related order or invoice.
+
+        :param date server_due_date: The due date parsed with `_parse_due_date`.
+        """
+        sale_order = self.sale_order_ids.filtered_domain([('name', '=', self.reference)])
+        inv = self.invoice_ids.filtered_domain([('name', '=', self.reference)])
+        date_difference = (server_due_date - date.today()).days
+        # `nb_days` is indexed by this module, the lookup does not scan all the term lines
+        payment_term = self.env['account.payment.term'].sudo().search([('line_ids.nb_days', '=', date_difference)],
+                                                                      limit=1)
         if not payment_term:
             payment_term_vals = {
                 'name': _('Novalnet payment due - {} Days').format(date_difference),
@@ -545,11 +657,8 @@ class PaymentTransaction(models.Model):
 
     def _create_transaction_payload(self, notification_data):
         """Prepare transaction data"""
-        # Get versions
-        odoo_version = service.common.exp_version()['server_version']
-
-        module = self.env.ref('base.module_payment_novalnet').installed_version
-        module_version = '.'.join(module.split('.')[2:])
+        # Get versions, both are cached for the life of the process
+        odoo_version = _odoo_server_version()
         # Convert amount to minor currency units
         converted_amount = payment_utils.to_minor_currency_units(self.amount, self.currency_id)
 
@@ -558,60 +667,51 @@ class PaymentTransaction(models.Model):
             'payment_type': notification_data['pm_data']['type'],
             'amount': converted_amount,
             'system_name': f'Odoo_{odoo_version}',
-            'system_version': f'{odoo_version}-NN{module_version}-NNT{self.provider_id.get_current_theme() or ""}',
+            'system_version': self.provider_id.novalnet_system_version,
             'currency': self.currency_id.name,
             'order_no': self.reference,
         }
+        paydata = notification_data.get('pay_data') or {}
         # test mode
-        if 'pay_data' in notification_data and 'test_mode' in notification_data['pay_data']:
-            transaction_payload['test_mode'] = notification_data['pay_data']['test_mode']
+        if 'test_mode' in paydata:
+            transaction_payload['test_mode'] = paydata['test_mode']
         # payment data form
-        payment_data_keys = ['token', 'pan_hash', 'unique_id', 'iban', 'wallet_token', 'bic']
-
-        params = {'transaction': {'payment_data': {}}}
-        paydata = notification_data.get('pay_data', {})
-        params['transaction']['payment_data'] = {key: paydata[key] for key in payment_data_keys if key in paydata}
-
-        if params['transaction']['payment_data']:
-            transaction_payload['payment_data'] = params['transaction']['payment_data']
-
-        if 'pay_data' in notification_data:
-            # create token
-            if 'create_token' in notification_data['pay_data']:
-                transaction_payload['create_token'] = notification_data['pay_data']['create_token']
-            # do redirect params
-            if 'do_redirect' in notification_data['pay_data']:
-                transaction_payload['enforce_3d'] = notification_data['pay_data']['do_redirect']
-            # due date params
-            if 'due_date' in notification_data['pay_data']:
-                get_payment_terms_date = self._compute_due_date_from_terms()
-                if get_payment_terms_date:
-                    transaction_payload['due_date'] = get_payment_terms_date
-                else:
-                    transaction_payload['due_date'] = (
-                            datetime.today() + timedelta(days=int(notification_data['pay_data']['due_date']))).strftime(
-                        "%Y-%m-%d")
-            # bank details params
-            if 'account_number' in notification_data['pay_data']:
-                payment_data = {
-                    'account_holder': notification_data['pay_data']['account_holder'],
-                    'account_number': notification_data['pay_data']['account_number'],
-                    'routing_number': notification_data['pay_data']['routing_number'],
-                }
-                transaction_payload['payment_data'] = payment_data
-            # zero amount booking params
-            if notification_data['pay_data'].get('payment_action') == 'zero_amount':
-                transaction_payload['amount'] = 0
-            # token params
-            if 'payment_ref' in notification_data['pay_data'] and 'token' in \
-                    notification_data['pay_data']['payment_ref']:
-                transaction_payload['payment_data'] = params['transaction']['payment_data']
-                transaction_payload['payment_data']['token'] = notification_data['pay_data']['payment_ref']['token']
-
+        payment_data = {key: paydata[key] for key in _PAYMENT_DATA_KEYS if key in paydata}
+        if payment_data:
+            transaction_payload['payment_data'] = payment_data
+        # create token
+        if 'create_token' in paydata:
+            transaction_payload['create_token'] = paydata['create_token']
+        # do redirect params
+        if 'do_redirect' in paydata:
+            transaction_payload['enforce_3d'] = paydata['do_redirect']
+        # due date params
+        if 'due_date' in paydata:
+            get_payment_terms_date = self._compute_due_date_from_terms()
+            if get_payment_terms_date:
+                transaction_payload['due_date'] = get_payment_terms_date
+            else:
+                transaction_payload['due_date'] = (
+                        datetime.today() + timedelta(days=int(paydata['due_date']))).strftime("%Y-%m-%d")
+        # bank details params
+        if 'account_number' in paydata:
+            transaction_payload['payment_data'] = {
+                'account_holder': paydata['account_holder'],
+                'account_number': paydata['account_number'],
+                'routing_number': paydata['routing_number'],
+            }
+        # zero amount booking params
+        if paydata.get('payment_action') == 'zero_amount':
+            transaction_payload['amount'] = 0
+        # token params
+        if 'token' in paydata.get('payment_ref', ()):
+            payment_data['token'] = paydata['payment_ref']['token']
+            transaction_payload['payment_data'] = payment_data
+
+        base_url = self.provider_id.get_base_url()
         _logger.info(self.operation)
-        _logger.info(self.provider_id.get_base_url())
+        _logger.info(base_url)
         if self.operation in ['online_redirect']:
-            base_url = self.provider_id.get_base_url()
             transaction_payload['return_url'] = urls.url_join(base_url, PaymentNovalnetController._return_url)
         return transaction_payload
 
@@ -648,20 +748,16 @@ class PaymentTransaction(models.Model):
         """
         Save server response bank details
         """
-        if not {'account_holder', 'bank_name', 'bank_place', 'bic', 'iban'} <= set(_bank_details):
+        if not _BANK_REQUIRED.issubset(_bank_details):
             return
+        # One probe on the indexed digest of the details instead of matching the five columns
         bank_info = self.env['novalnet.payment.transaction.bank'].search(
-            [('account_holder', '=', _bank_details['account_holder']), ('bank_name', '=', _bank_details['bank_name']),
-             ('bic', '=', _bank_details['bic']), ('iban', '=', _bank_details['iban']),
-             ('bank_place', '=', _bank_details['bank_place'])])
-
-        if bank_info:
-            self.novalnet_transaction_id.novalnet_bank_account = bank_info.id
-        else:
+            [('key_hash', '=', _bank_key_hash(_bank_details))], limit=1)
+        if not bank_info:
             bank_info = self.env['novalnet.payment.transaction.bank'].create(
                 {'account_holder': _bank_details['account_holder'], 'bank_place': _bank_details['bank_place'],
                  'bank_name': _bank_details['bank_name'], 'bic': _bank_details['bic'], 'iban': _bank_details['iban']})
-            self.novalnet_transaction_id.novalnet_bank_account = bank_info.id
+        self.novalnet_transaction_id.novalnet_bank_account = bank_info.id
 
     def _validate_instament_details(self, instalment_details, currency_id):
         """
@@ -671,7 +767,8 @@ class PaymentTransaction(models.Model):
         instalment_info = self.env['novalnet.payment.instalment.details'].create(
             {'current_executed_cycle': instalment_details['cycles_executed'],
              'due_instalment': instalment_details['pending_cycles'],
-             'cycle_amount': format_amount(self.env, amount, currency_id),
+             'cycle_amount': amount,
+             'currency_id': currency_id.id,
              'next_instalment_date': instalment_details['next_cycle_date'],
              'instalment_all_details': instalment_details})
         self.novalnet_transaction_id.novalnet_instalment_information = instalment_info.id
@@ -682,37 +779,36 @@ class PaymentTransaction(models.Model):
         """
         if not _nearest_stores:
             return
-        store_values = []
-        for key, val in _nearest_stores.items():
-            store_values.append((0, 0, {
-                'city': val.get('city'),
-                'country_code': val.get('country_code'),
-                'store_name': val.get('store_name'),
-                'street': val.get('street'),
-                'zip': val.get('zip'),
-            }))
-
-        self.novalnet_transaction_id.write({
-            'novalnet_nearest_store_ids': store_values,
-        })
-
-    def _validate_create_multibanco_payment_info(self, _partner_payment_reference, _service_supplier_id):
-        """
-        Save server response multibanco payment details
+        # Created in one batch with the link to the Novalnet details set directly, rather than through x2many
+        # commands written on the parent
+        nn_transaction_id = self.novalnet_transaction_id.id
+        self.env['novalnet.payment.transaction.store'].create([{
+            'novalnet_nearest_store_ids': nn_transaction_id,
+            'city': val.get('city'),
+            'country_code': val.get('country_code'),
+            'store_name': val.get('store_name'),
+            'street': val.get('street'),
+            'zip': val.get('zip'),
+        } for val in _nearest_stores.values()])
+
+    def _get_multibanco_payment_info_vals(self, _partner_payment_reference, _service_supplier_id):
+        """
+        Prepare the server response multibanco payment details to be saved on the Novalnet details
         """
         if not _partner_payment_reference or not _service_supplier_id:
-            return
-        self.novalnet_transaction_id.novalnet_multibanco_payment_reference = _partner_payment_reference
-        self.novalnet_transaction_id.novalnet_multibanco_service_supplier_id = _service_supplier_id
+            return {}
+        return {
+            'novalnet_multibanco_payment_reference': _partner_payment_reference,
+            'novalnet_multibanco_service_supplier_id': _service_supplier_id,
+        }
 
     def _get_specific_processing_values(self, processing_values):
         """
         Processes payment values for Novalnet, validating input data and handling server response based on
         operation.
         """
-        res = super()._get_specific_rendering_values(processing_values)
-        if self.provider_code != 'novalnet':
-            return res
+        if not self.is_novalnet:
+            return super()._get_specific_processing_values(processing_values)
         payment_data = request.params.get('pay_data', {})
         pm_data = request.params.get('pm_data', {})
 
@@ -737,37 +833,44 @@ class PaymentTransaction(models.Model):
             _novalnet_transaction_dict = {
                 'payment_type': pm_data['name'],
             }
+            # The zero amount flag is part of the same INSERT rather than a separate UPDATE
+            if 'payment_action' in payment_data and payment_data['payment_action'] == 'zero_amount':
+                _novalnet_transaction_dict['zero_amount_check_flag'] = 1
             self.novalnet_transaction_id = self.env['payment.novalnet.transaction'].create(
                 _novalnet_transaction_dict)
-            if 'payment_action' in payment_data and payment_data['payment_action'] == 'zero_amount':
-                self.novalnet_transaction_id.zero_amount_check_flag = 1
 
+        txn = payment_response.get('transaction') or {}
+        result = payment_response.get('result') or {}
         if self.operation in ['online_direct', 'online_token', 'offline']:
-            if 'transaction' not in payment_response or 'tid' not in payment_response.get('transaction'):
+            if not txn.get('tid'):
                 raise ValidationError(_("Invalid transaction"))
-            self.provider_reference = payment_response.get('transaction')['tid']
-            self.novalnet_transaction_id.tid = str(payment_response.get('transaction')['tid'])
-            self.novalnet_transaction_id.status = str(payment_response.get('transaction')['status'])
-            self.novalnet_transaction_id.status_code = str(payment_response.get('transaction')['status_code'])
-            self.novalnet_transaction_id.payment_name = str(pm_data['name'])
-            self.novalnet_transaction_id.novalnet_test_mode = str(payment_response.get('transaction')['test_mode'])
-            if 'invoice_ref' in payment_response['transaction']:
-                self.novalnet_transaction_id.payment_reference_two = str(
-                    payment_response.get('transaction')['invoice_ref'])
-            if 'due_date' in payment_response['transaction']:
-                transaction = payment_response.get('transaction', {})
-                self.set_novalnet_payment_terms(transaction.get('due_date'))
-                self.novalnet_transaction_id.novalnet_due_date = datetime.strptime(
-                    transaction.get('due_date'), '%Y-%m-%d').strftime('%d/%m/%Y')
-            return {'nn_tid': str(payment_response.get('transaction')['tid'])}
+            tid = str(txn['tid'])
+            self.provider_reference = txn['tid']
+            # The Novalnet details are collected and written at once, a single UPDATE
+            nn_vals = {
+                'tid': tid,
+                'status': str(txn['status']),
+                'status_code': txn['status_code'],
+                'payment_name': str(pm_data['name']),
+                'novalnet_test_mode': str(txn['test_mode']) == '1',
+            }
+            if 'invoice_ref' in txn:
+                nn_vals['payment_reference_two'] = str(txn['invoice_ref'])
+            if 'due_date' in txn:
+                due_date, display_due_date = _parse_due_date(txn['due_date'])
+                self.set_novalnet_payment_terms(due_date)
+                nn_vals['novalnet_due_date'] = display_due_date
+            self.novalnet_transaction_id.write(nn_vals)
+            return {'nn_tid': tid}
         elif self.operation in ['online_redirect']:
-            if 'transaction' not in payment_response or 'txn_secret' not in payment_response.get(
-                    'transaction') or 'redirect_url' not in payment_response.get('result'):
+            if not (txn.get('txn_secret') and result.get('redirect_url')):
                 raise ValidationError(_("Could not redirect to acquirer, please try again later"))
-            self.novalnet_transaction_id.novalnet_txn_secret = payment_response.get('transaction')['txn_secret']
-            self.novalnet_transaction_id.payment_name = str(pm_data['name'])
-            self.novalnet_transaction_id.novalnet_test_mode = str(payment_data['test_mode'])
-            return {'redirect_url': payment_response.get('result')['redirect_url']}
+            self.novalnet_transaction_id.write({
+                'novalnet_txn_secret': txn['txn_secret'],
+                'payment_name': str(pm_data['name']),
+                'novalnet_test_mode': str(payment_data['test_mode']) == '1',
+            })
+            return {'redirect_url': result['redirect_url']}
 
     def _get_specific_rendering_values(self, processing_values):
         """
@@ -781,6 +884,4 @@ class PaymentTransaction(models.Model):
         """
         if not payment_data:
             return
-        if 'payment_action' in payment_data and payment_data['payment_action'] == "authorized":
-            return "authorize"
-        return "payment"
+        return "authorize" if payment_data.get('payment_action') == "authorized" else "payment"
@@ -1,7 +1,22 @@
 """
 Store Novalnet Transaction Payment Informationy
 """
-from odoo import fields, models
+import hashlib
+
+from odoo import api, fields, models
+from odoo.tools import format_amount
+
+_BANK_KEY_FIELDS = ('account_holder', 'bank_name', 'bic', 'iban', 'bank_place')
+
+
+def _bank_key_hash(values):
+    """ Digest identifying a set of bank details, so that they are matched on one indexed column.
+
+    :param values: A mapping holding the values of `_BANK_KEY_FIELDS`.
+    :return: The hexadecimal SHA-1 digest of the values.
+    :rtype: str
+    """
+    return hashlib.sha1('|'.join(values[key] or '' for key in _BANK_KEY_FIELDS).encode()).hexdigest()
 
 
 class NovalnetPaymentTransactionBank(models.Model):
@@ -16,6 +31,12 @@ class NovalnetPaymentTransactionBank(models.Model):
     bank_place = fields.Char(string="Place of the bank that need to be transferred")
     bic = fields.Char(string="BIC")
     iban = fields.Char(string="IBAN")
+    key_hash = fields.Char(string="Bank details key", compute='_compute_key_hash', store=True, index=True)
+
+    @api.depends(*_BANK_KEY_FIELDS)
+    def _compute_key_hash(self):
+        for bank in self:
+            bank.key_hash = _bank_key_hash(bank)
 
 
 class NovalnetPaymentTransactionStore(models.Model):
@@ -44,6 +65,14 @@ class NovalnetPaymentInstalmentDetails(models.Model):
 
     current_executed_cycle = fields.Integer(string="Current Cycle")
     due_instalment = fields.Integer(string="Due Instalment")
-    cycle_amount = fields.Char(string="Cycle Amount")
+    currency_id = fields.Many2one('res.currency', string="Currency")
+    cycle_amount = fields.Monetary(string="Cycle Amount", currency_field='currency_id')
+    cycle_amount_display = fields.Char(string="Formatted Cycle Amount", compute='_compute_cycle_amount_display')
     next_instalment_date = fields.Char(string="Next Instalment Date")
     instalment_all_details = fields.Json(string="Instalment All Details")
+
+    @api.depends('cycle_amount', 'currency_id')
+    def _compute_cycle_amount_display(self):
+        """ Format the cycle amount only when it is displayed, not when a notification stores it. """
+        for instalment in self:
+            instalment.cycle_amount_display = format_amount(self.env, instalment.cycle_amount, instalment.currency_id)
@@ -27,6 +27,10 @@ paymentForm.include({
       * Connect the shop's iframe with the NovalnetUtility.js file
      */
        await this._super(...arguments);
+       // No payment form was loaded for Novalnet, the template shows a notice instead of the iframe
+       if (!this.el.querySelector('#novalnet_iframe')) {
+           return;
+       }
        this.novalnetPaymentIframe = new NovalnetPaymentForm();
        const paymentFormRequestObj = {
            iframe: '#novalnet_iframe',
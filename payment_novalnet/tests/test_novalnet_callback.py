@@ -0,0 +1,110 @@
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+from unittest.mock import patch
+
+from odoo.exceptions import ValidationError
+from odoo.tests import tagged
+
+from odoo.addons.payment.tests.common import PaymentCommon
+from odoo.addons.payment_novalnet.models.novalnet_callback import _CALLBACK_MAX_ATTEMPTS
+
+_TX_MODULE = 'odoo.addons.payment_novalnet.models.payment_transaction'
+_CALLBACK_MODULE = 'odoo.addons.payment_novalnet.models.novalnet_callback'
+_NOVALNET_IP = '213.95.190.5'
+
+
+@tagged('post_install', '-at_install')
+class TestNovalnetCallback(PaymentCommon):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.provider = cls._prepare_provider('novalnet')
+
+    def setUp(self):
+        super().setUp()
+        self.tx = self._create_transaction(flow='direct')
+
+    def _create_callback(self, check_sum, **values):
+        return self.env['novalnet.callback'].create({
+            'event_type': 'CREDIT',
+            'parent_tid': '14000000000000001',
+            'check_sum': check_sum,
+            'transaction_id': self.tx.id,
+            'callback_json': {'event': {'type': 'CREDIT', 'checksum': check_sum}},
+            **values,
+        })
+
+    def _patch_validate_callback(self, **kwargs):
+        return patch.object(self.registry['novalnet.callback'], '_validate_callback', **kwargs)
+
+    def test_replayed_webhook_is_stored_once(self):
+        """ Test that a notification that Novalnet sends again does not store a second callback. """
+        notification_data = {
+            'event_type': 'CREDIT',
+            'nn_tid': '14000000000000001',
+            'check_sum': 'replayed-checksum',
+            'nn_callback_data': {'event': {'type': 'CREDIT', 'checksum': 'replayed-checksum'}},
+        }
+        with patch(f'{_TX_MODULE}._resolve_cached', return_value=_NOVALNET_IP), \
+                patch(f'{_TX_MODULE}.payment_utils.get_customer_ip_address', return_value=_NOVALNET_IP):
+            self.tx._initiate_transaction_callback(notification_data)
+            self.tx._initiate_transaction_callback(notification_data)
+
+        callback_count = self.env['novalnet.callback'].search_count([
+            ('parent_tid', '=', '14000000000000001'),
+            ('event_type', '=', 'CREDIT'),
+            ('check_sum', '=', 'replayed-checksum'),
+        ])
+        self.assertEqual(callback_count, 1)
+
+    def test_failing_callback_counts_attempt(self):
+        """ Test that a callback raising an error is kept pending with one more attempt. """
+        callback = self._create_callback('failing-checksum')
+        with self._patch_validate_callback(side_effect=ValidationError("Novalnet is down")):
+            self.env['novalnet.callback']._cron_process_pending_callbacks()
+
+        self.assertFalse(callback.is_done)
+        self.assertEqual(callback.attempt_count, 1)
+
+    def test_incomplete_callback_counts_attempt(self):
+        """ Test that a callback left not done without an error also counts as an attempt. """
+        callback = self._create_callback('incomplete-checksum')
+        with self._patch_validate_callback(return_value=None):
+            self.env['novalnet.callback']._cron_process_pending_callbacks()
+
+        self.assertFalse(callback.is_done)
+        self.assertEqual(callback.attempt_count, 1)
+
+    def test_callback_skipped_after_max_attempts(self):
+        """ Test that the cron no longer processes a callback once its attempts are exhausted. """
+        callback = self._create_callback('exhausted-checksum', attempt_count=_CALLBACK_MAX_ATTEMPTS - 1)
+        with self._patch_validate_callback(side_effect=ValidationError("Novalnet is down")) as validate_mock:
+            self.env['novalnet.callback']._cron_process_pending_callbacks()
+            self.assertEqual(callback.attempt_count, _CALLBACK_MAX_ATTEMPTS)
+            validate_mock.reset_mock()
+            self.env['novalnet.callback']._cron_process_pending_callbacks()
+
+        validate_mock.assert_not_called()
+        self.assertEqual(callback.attempt_count, _CALLBACK_MAX_ATTEMPTS)
+
+    def test_full_batch_triggers_cron_again(self):
+        """ Test that the cron triggers itself again when a full batch was taken. """
+        for index in range(3):
+            self._create_callback(f'batch-checksum-{index}')
+        with patch(f'{_CALLBACK_MODULE}._CALLBACK_BATCH_SIZE', 2), \
+                self._patch_validate_callback(return_value=None), \
+                patch.object(self.registry['ir.cron'], '_trigger') as trigger_mock:
+            self.env['novalnet.callback']._cron_process_pending_callbacks()
+
+        trigger_mock.assert_called_once()
+
+    def test_partial_batch_does_not_trigger_cron(self):
+        """ Test that the cron does not trigger itself again once the pending callbacks fit in the batch. """
+        self._create_callback('last-batch-checksum')
+        with patch(f'{_CALLBACK_MODULE}._CALLBACK_BATCH_SIZE', 2), \
+                self._patch_validate_callback(return_value=None), \
+                patch.object(self.registry['ir.cron'], '_trigger') as trigger_mock:
+            self.env['novalnet.callback']._cron_process_pending_callbacks()
+
+        trigger_mock.assert_not_called()